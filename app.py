@@ -1,15 +1,6 @@
 import streamlit as st
-import pandas as pd
-import geopandas as gpd
-import folium
-from folium.plugins import MarkerCluster
-from streamlit_folium import folium_static, st_folium
-import branca.colormap as cm
-import json
-from shapely.geometry import Point
-from shapely.ops import nearest_points
-import os
-import numpy as np
+
+import startup
 
 # Set the page title and layout
 st.set_page_config(
@@ -17,39 +8,57 @@ st.set_page_config(
     layout="wide"
 )
 
-sites_path = 'Sites_with_Clusters.geojson'
-calls_path = 'Overdose_zip_geocodio.csv'
-mainroads_path = 'MainRoads.geojson'
-transit_path = 'Transit.geojson'
+# Modules and datasets load in a background thread shared by every session,
+# so the page skeleton below is sent before anything heavy is imported
+app_startup = startup.start()
+
+# App title
+st.title("Pierce County Sites Visualization")
+
+# Create layout with columns
+col1, col2 = st.columns([7, 3])
+
+with col1:
+    loading_status = st.empty()
+    while not app_startup.wait(startup.READY_PHASE, timeout=0.2):
+        loading_status.info(f"Loading {(app_startup.current or 'data').lower()}...")
+    loading_status.empty()
+
+# Already imported by the startup thread
+import numpy as np
+import pandas as pd
+import folium
+from streamlit_folium import st_folium
 
-# Load K-means algorithm and scaler
-k_means_algo = pd.read_pickle('kmeans_algo.pkl')
-std_scaler = k_means_algo['scaler']
-k_means = k_means_algo['kmeans']
+import cluster_grid
+import data_loader
+import density
+from caching import LRUCache
+import map_layers
+import placement
+import proximity
+import road_network
+import scoring
+import shared_arrays
 
-sites = gpd.read_file(sites_path)
-sites = sites.to_crs('EPSG:4326')
+# Datasets are cached per process, so reruns and other sessions reuse them
+sites = data_loader.load_sites().wgs84
 #sites = sites.rename(columns={'Nearby_Cou': 'Nearby_Count_500',
 #                              'Nearby_C_1': 'Nearby_Count_1000',
 #                              'Nearby_C_2': 'Nearby_Count_2000',
 #                              'Nearby_C_3': 'Nearby_Count_3000',
 #                              'Nearest_Tr':'Nearest_Transit_Distance', 
 #                              'Nearest_Ro':'Nearest_Road_Distance'}) # strange saving issue with the shapefile
+# Call locations for drawing, from the shared memory-mapped arrays when
+# they have been exported (shared_arrays.py)
+shared = shared_arrays.open_shared()
+calls = shared.calls_lonlat if shared is not None else data_loader.load_calls().lonlat
 
-calls = pd.read_csv(calls_path)
-calls = gpd.GeoDataFrame(calls, geometry=gpd.points_from_xy(calls.Longitude, calls.Latitude), crs='EPSG:4326')
+# Precomputed cluster grid (built with cluster_grid.py), None if not available
+cluster_surface = cluster_grid.load_grid()
 
-mainroads = gpd.read_file(mainroads_path)
-mainroads = mainroads.to_crs('EPSG:4326')
-
-transit = gpd.read_file(transit_path)
-transit = transit.to_crs('EPSG:4326')
-
-# App title
-st.title("Pierce County Sites Visualization")
-
-# Create layout with columns
-col1, col2 = st.columns([7, 3])
+# Precomputed road network (built with road_network.py), None if not available
+transit_network = road_network.load_network()
 
 # Sidebar for filtering
 with st.sidebar:
@@ -79,8 +88,85 @@ with st.sidebar:
         default=None
     )
     
+    # Date window for call counts, when the calls have dates
+    call_window = None
+    temporal_index = proximity.temporal_call_index()
+    if temporal_index is not None and len(temporal_index):
+        first_day, last_day = temporal_index.date_range()
+        date_range = st.date_input(
+            "Call Date Range",
+            value=(first_day, last_day),
+            min_value=first_day,
+            max_value=last_day
+        )
+        # Counts use start <= date < end, so the end date is made inclusive
+        if len(date_range) == 2 and tuple(date_range) != (first_day, last_day):
+            call_window = (
+                np.datetime64(date_range[0], 'ns'),
+                np.datetime64(date_range[1], 'ns') + np.timedelta64(1, 'D')
+            )
+    
     # Option to display calls data
     show_calls = st.checkbox("Show Call Data Points", value=False)
+    calls_mode = st.selectbox(
+        "Call Display Mode",
+        options=map_layers.CALL_RENDER_MODES,
+        disabled=not show_calls
+    )
+    max_call_points = st.number_input(
+        "Maximum Call Points Drawn",
+        min_value=1000,
+        max_value=max(len(calls), 1000),
+        value=min(map_layers.MAX_CALL_POINTS, max(len(calls), 1000)),
+        step=1000,
+        disabled=not show_calls
+    )
+    
+    # Kernel density surface of the calls (for the selected date range)
+    show_density = st.checkbox("Show Call Density", value=False)
+    
+    # Options for the precomputed cluster grid, when it has been built
+    show_surface = False
+    use_grid_for_clicks = False
+    if cluster_surface is not None:
+        show_surface = st.checkbox("Show Cluster Surface", value=False)
+        use_grid_for_clicks = st.checkbox(
+            "Use Precomputed Grid for Custom Points",
+            value=True,
+            help="Answer clicks from the nearest grid cell instead of computing exact values"
+        )
+    
+    # Measure custom point transit distance along the roads, when the network has been built
+    use_network_distance = False
+    if transit_network is not None:
+        use_network_distance = st.checkbox(
+            "Measure Transit Distance Along Roads",
+            value=False,
+            help="Travel distance over the main road network instead of a straight line"
+        )
+    
+    # Choose the highlighted sites that together cover the most calls
+    st.markdown("---")
+    st.markdown("### Site Placement")
+    placement_k = st.number_input(
+        "Number of Sites to Choose",
+        min_value=1,
+        max_value=max(len(sites), 1),
+        value=min(5, max(len(sites), 1)),
+        step=1
+    )
+    placement_radius = st.selectbox(
+        "Coverage Radius (m)",
+        options=proximity.NEARBY_RADII,
+        index=proximity.NEARBY_RADII.index(placement.COVERAGE_RADIUS),
+        help="Also used for the coverage shown in the details panel"
+    )
+    placement_ilp = st.checkbox(
+        "Refine with Integer Programming",
+        value=False,
+        help="Slower, but proves the choice optimal when it finishes within the time limit"
+    )
+    find_best_sites = st.button("Find Best Sites", help="Choose among the highlighted sites")
     
     # Additional filters
     st.markdown("---")
@@ -90,11 +176,60 @@ with st.sidebar:
     st.markdown("- Click anywhere else on the map to calculate nearby calls")
     st.markdown("- Use the cluster filter to highlight specific groups")
     st.markdown("- Toggle call data points to view service call locations")
+    
+    # Time spent importing and loading each part of the app in this process
+    with st.expander("Startup Timing", expanded=False):
+        st.text("\n".join(app_startup.report()))
 
 # Initialize session state to store the selected site and custom point data
 if 'selected_site_id' not in st.session_state:
     st.session_state.selected_site_id = None
 
+# Recompute site counts and clusters for the selected call date window
+sites = scoring.sites_for_window(sites, call_window)
+
+# Solve the placement problem over the highlighted sites
+if find_best_sites:
+    candidates = np.flatnonzero(map_layers.highlighted_sites(
+        sites, selected_clusters, nearby_1000_threshold, nearby_3000_threshold
+    ))
+    coverage = placement.cached_coverage(sites, placement_radius, call_window)
+    result = placement.solve(coverage[candidates], placement_k, ilp=placement_ilp)
+    st.session_state.placement = {
+        'site_ids': tuple(sites.index[candidates[result.selected]]),
+        'gains': result.gains,
+        'covered': result.covered,
+        'total': result.total,
+        'radius': placement_radius,
+        'optimal': result.optimal,
+        'ilp': placement_ilp,
+    }
+chosen_site_ids = st.session_state.placement['site_ids'] if 'placement' in st.session_state else ()
+
+# Sites excluded from the coverage shown in the details panel
+if 'inactive_site_ids' not in st.session_state:
+    st.session_state.inactive_site_ids = set()
+
+
+def get_coverage_tracker():
+    # Built on first use, and again when the sites, radius or date range change;
+    # toggling a site afterwards updates it incrementally
+    # (the sites frame is compared by identity, so a reloaded frame that
+    # happens to reuse the old id still rebuilds it)
+    tracker_key = (placement_radius, call_window)
+    if (st.session_state.get('coverage_tracker_key') != tracker_key
+            or st.session_state.get('coverage_tracker_sites') is not sites):
+        active = np.flatnonzero(~sites.index.isin(list(st.session_state.inactive_site_ids)))
+        st.session_state.coverage_tracker = placement.site_tracker(sites, placement_radius, call_window, active)
+        st.session_state.coverage_tracker_key = tracker_key
+        st.session_state.coverage_tracker_sites = sites
+    return st.session_state.coverage_tracker
+
+
+def toggle_site_coverage(site_id):
+    get_coverage_tracker().toggle(sites.index.get_loc(site_id))
+    st.session_state.inactive_site_ids ^= {site_id}
+
 # Filter the data based on selection
 if selected_clusters:
     filtered_sites = sites[sites['Cluster'].isin(selected_clusters)]
@@ -103,123 +238,41 @@ else:
     filtered_sites = sites
     map_sites = sites
 
-# Create the map
-with col1:
+# Create color maps
+site_colors = {
+    1: '#2e5777',  # Deep blue-gray
+    2: '#0194d3',  # Bright blue
+    3: '#3d7527'   # Earthy green
+}
+
+call_colors = {
+    1: '#FF0000',  # Red for high priority
+    2: '#FF9800',  # Orange for medium priority
+    3: '#4CAF50'   # Green for low priority
+}
+
+
+def build_map(nearby_1000_threshold, nearby_3000_threshold, selected_clusters,
+              show_calls, calls_mode, max_call_points, show_surface, chosen_site_ids,
+              call_density):
+    # map_sites and call_density already reflect the call date window
     # Create a folium map centered on Pierce County
     m = folium.Map(
         location=[47.2, -122.4],  # Pierce County coordinates
         zoom_start=10,
-        tiles="OpenStreetMap"
+        tiles="OpenStreetMap",
+        prefer_canvas=True
     )
     
-    # Create color maps
-    site_colors = {
-        1: '#2e5777',  # Deep blue-gray
-        2: '#0194d3',  # Bright blue
-        3: '#3d7527'   # Earthy green
-    }
-    
-    call_colors = {
-        1: '#FF0000',  # Red for high priority
-        2: '#FF9800',  # Orange for medium priority
-        3: '#4CAF50'   # Green for low priority
-    }
-    
-    # Create feature groups
-    site_groups = {
-        1: folium.FeatureGroup(name="Cluster 1 Sites"),
-        2: folium.FeatureGroup(name="Cluster 2 Sites"),
-        3: folium.FeatureGroup(name="Cluster 3 Sites")
-    }
-    
-    calls_group = folium.FeatureGroup(name="Service Calls")
-    
-    # Add site points to the map with unique IDs
-    for idx, site in map_sites.iterrows():
-        # Determine if this point should be highlighted based on cluster filter
-        is_cluster_highlighted = (not selected_clusters) or (site['Cluster'] in selected_clusters)
-
-        # Determine if the site meets proximity thresholds
-        meets_proximity_criteria = (
-            site['Nearby_Count_1000'] >= nearby_1000_threshold and
-            site['Nearby_Count_3000'] >= nearby_3000_threshold
-        )
-
-        # Final visibility condition
-        is_highlighted = is_cluster_highlighted and meets_proximity_criteria
-
-        # Set marker properties based on highlighting
-        marker_color = site_colors[site['Cluster']]
-        marker_opacity = 1.0 if is_highlighted else 0.2
-        marker_radius = 8 if is_highlighted else 6
-        
-        # Create tooltip content
-        tooltip_html = f"""
-        <div style="font-family: Arial; font-size: 12px;">
-            <b>{site['Type']}</b><br>
-            {site['Address']}, {site['City']}<br>
-            Cluster: {site['Cluster']}
-        </div>
-        """
-        
-        # Create a unique ID for each site marker for click handling
-        site_id = f"site_{idx}"
-        
-        # Add the marker to the appropriate cluster group
-        circle = folium.CircleMarker(
-            location=[site.geometry.y, site.geometry.x],
-            radius=marker_radius,
-            color=marker_color,
-            fill=True,
-            fill_color=marker_color,
-            fill_opacity=marker_opacity,
-            opacity=marker_opacity,
-            tooltip=folium.Tooltip(tooltip_html),
-        )
-        
-        # Add site ID to the marker as a custom property
-        circle.add_to(site_groups[site['Cluster']])
-        
-        # Add onclick JavaScript to set a hidden input field with the site ID
-        circle.add_child(folium.Element(f"""
-            <script>
-            var el = document.querySelector('circle:last-child');
-            el.setAttribute('id', '{site_id}');
-            el.onclick = function() {{
-                // Use Streamlit's setComponentValue to pass back the ID
-                if (window.parent.streamlitApp) {{
-                    window.parent.streamlitApp.setComponentValue('{site_id}');
-                }}
-            }};
-            </script>
-        """))
+    # One GeoJSON layer per cluster, keeping the layer control entries
+    site_groups = map_layers.site_layers(
+        map_sites, site_colors, selected_clusters,
+        nearby_1000_threshold, nearby_3000_threshold
+    )
     
-    # Add call points to the map if enabled
+    # Add call points to the map as a single layer if enabled
     if show_calls:
-        for idx, call in calls.iterrows():
-            # Set marker properties
-            marker_color = 'black'
-            # Create tooltip content
-            #tooltip_html = f"""
-            #<div style="font-family: Arial; font-size: 12px;">
-            #    <b>Call ID:</b> {call['Call_ID']}<br>
-            #    <b>Type:</b> {call['Type']}<br>
-            #    <b>Date:</b> {call['Date']}<br>
-            #    <b>Priority:</b> {call['Priority']}
-            #</div>
-            #"""
-            
-            # Add star markers for calls
-            folium.CircleMarker(
-                location=[call.geometry.y, call.geometry.x],
-                radius=2,  # smaller than site markers
-                color='black',
-                fill=True,
-                fill_color='black',
-                fill_opacity=0.4,
-                opacity=0.4,
-                #tooltip=folium.Tooltip(tooltip_html),
-            ).add_to(calls_group)
+        calls_group = map_layers.calls_layer(calls, mode=calls_mode, cap=max_call_points)
     
     # Add all feature groups to the map
     for cluster_id, feature_group in site_groups.items():
@@ -228,6 +281,28 @@ with col1:
     if show_calls:
         calls_group.add_to(m)
     
+    # Ring the sites chosen by the placement solver
+    if chosen_site_ids:
+        map_layers.chosen_sites_layer(map_sites.loc[list(chosen_site_ids)]).add_to(m)
+    
+    # Add the precomputed cluster surface as an image layer
+    if show_surface:
+        folium.raster_layers.ImageOverlay(
+            image=cluster_grid.cluster_image(cluster_surface, site_colors),
+            bounds=cluster_surface.bounds_lonlat(),
+            origin='lower',
+            name="Cluster Surface"
+        ).add_to(m)
+    
+    # Add the call density surface as an image layer
+    if call_density is not None:
+        folium.raster_layers.ImageOverlay(
+            image=density.density_image(call_density),
+            bounds=call_density.bounds_lonlat(),
+            origin='lower',
+            name="Call Density"
+        ).add_to(m)
+    
     # Add layer control
     folium.LayerControl().add_to(m)
     
@@ -281,9 +356,59 @@ with col1:
     
     legend_html += '</div>'
     m.get_root().html.add_child(folium.Element(legend_html))
+    return m
+
+
+# Create the map
+with col1:
+    # Reuse the map built for the same filter values earlier in this session,
+    # which also keeps the component from re-rendering in the browser
+    if 'map_cache' not in st.session_state:
+        st.session_state.map_cache = LRUCache(maxsize=8)
+    map_filters = (
+        nearby_1000_threshold, nearby_3000_threshold, tuple(sorted(selected_clusters)),
+        show_calls, calls_mode, max_call_points, show_surface, chosen_site_ids
+    )
+    # The drawn data is part of the key too, so a reloaded sites or calls file,
+    # cluster grid or density surface builds a new map
+    call_density = density.call_density_surface(window=call_window) if show_density else None
+    map_sources = (map_sites, calls, cluster_surface, call_density)
+    map_key = map_filters + (call_window,) + tuple(id(source) for source in map_sources)
+    m = st.session_state.map_cache.get(
+        map_key, lambda: build_map(*map_filters, call_density), sources=map_sources
+    )
     
     # Display the map and capture click events
-    map_data = st_folium(m, width=800, height=600, returned_objects=["last_object_clicked", "last_clicked"])
+    map_data = st_folium(m, width=800, height=600, returned_objects=["last_object_clicked", "last_clicked", "last_active_drawing"])
+    
+    # List the sites chosen by the placement solver
+    if 'placement' in st.session_state:
+        best_sites = st.session_state.placement
+        chosen = sites.loc[list(best_sites['site_ids'])]
+        st.subheader("Best Sites")
+        if best_sites['optimal']:
+            quality = "optimal"
+        elif best_sites.get('ilp'):
+            # The integer program hit its time limit before proving optimality
+            quality = "best found"
+        else:
+            quality = "greedy, at least 63% of optimal"
+        st.caption(
+            f"{best_sites['covered']} of {best_sites['total']} calls within {best_sites['radius']}m "
+            f"covered ({quality})"
+        )
+        st.dataframe(
+            pd.DataFrame({
+                'Type': chosen['Type'].to_numpy(),
+                'Address': chosen['Address'].to_numpy(),
+                'City': chosen['City'].to_numpy(),
+                'New Calls Covered': best_sites['gains'],
+            }),
+            hide_index=True
+        )
+        if st.button("Clear Best Sites"):
+            del st.session_state.placement
+            st.rerun()
     
 # Process click events
 clicked_on_site = False
@@ -293,110 +418,72 @@ if map_data.get("last_clicked") is not None:
     click_lat = map_data["last_clicked"]["lat"]
     click_lng = map_data["last_clicked"]["lng"]
     
-    # Create a click ID to detect duplicate clicks
-    current_click_id = f"{click_lat:.6f}_{click_lng:.6f}"
+    # Create a click ID to detect duplicate clicks (a new call date window
+    # or distance option rescores the same click)
+    current_click_id = f"{click_lat:.6f}_{click_lng:.6f}_{call_window}_{use_network_distance}"
     
     # Check if this is a new click we haven't processed yet
     if 'last_processed_click' not in st.session_state or st.session_state.last_processed_click != current_click_id:
         # Update last processed click
         st.session_state.last_processed_click = current_click_id
         
-        # First check if this is a known site
-        for idx, row in sites.iterrows():
-            site_lat = row.geometry.y
-            site_lng = row.geometry.x
-            if abs(site_lat - click_lat) < 0.0001 and abs(site_lng - click_lng) < 0.0001:
-                st.session_state.selected_site_id = idx
-                clicked_on_site = True
-                if 'custom_point' in st.session_state:
-                    del st.session_state.custom_point
-                if 'custom_point_counts' in st.session_state:
-                    del st.session_state.custom_point_counts
-                if 'custom_point_distances' in st.session_state:
-                    del st.session_state.custom_point_distances
-                if 'custom_point_cluster' in st.session_state:
-                    del st.session_state.custom_point_cluster
-                break
+        # First check if this is a known site: a click on a site marker sends
+        # back its GeoJSON feature, otherwise look for a site within the marker
+        # radius at the initial zoom (the zoom is not returned by st_folium,
+        # since every zoom change would rerun the script)
+        site_id = None
+        clicked_feature = map_data.get("last_active_drawing")
+        if (map_data.get("last_object_clicked") == map_data["last_clicked"]
+                and clicked_feature and 'site_id' in clicked_feature.get('properties', {})):
+            site_id = clicked_feature['properties']['site_id']
+        else:
+            tolerance = proximity.pixel_tolerance(click_lng, click_lat, zoom=10)
+            site_id = proximity.site_locator().nearest_within(
+                data_loader.project_points(click_lng, click_lat)[0], tolerance
+            )
+        
+        if site_id is not None:
+            st.session_state.selected_site_id = site_id
+            clicked_on_site = True
+            if 'custom_point' in st.session_state:
+                del st.session_state.custom_point
+            if 'custom_point_counts' in st.session_state:
+                del st.session_state.custom_point_counts
+            if 'custom_point_distances' in st.session_state:
+                del st.session_state.custom_point_distances
+            if 'custom_point_cluster' in st.session_state:
+                del st.session_state.custom_point_cluster
         
         # If not a known site, create a custom point
         if not clicked_on_site:
             st.session_state.selected_site_id = None
             st.session_state.custom_point = (click_lat, click_lng)
             
-            # Create a temporary point geometry
-            point = Point(click_lng, click_lat)
-            custom_point_gdf = gpd.GeoDataFrame(geometry=[point], crs='EPSG:4326')
-            
-            # Calculate nearby counts
-            custom_point_gdf = custom_point_gdf.to_crs(epsg=3857)
-            calls_gdf_3857 = calls.to_crs(epsg=3857)
-            
-            # Initialize counts dictionary
-            nearby_counts = {}
-            
-            # Calculate for each distance
-            for distance in [500, 1000, 2000, 3000]:
-                buffer = custom_point_gdf.geometry[0].buffer(distance)
-                count = calls_gdf_3857[calls_gdf_3857.geometry.within(buffer)].shape[0]
-                nearby_counts[f'Nearby_Count_{distance}'] = count
+            # Compute the features and K-means cluster for the clicked point,
+            # either from the precomputed grid cell or exactly
+            # (the grid holds all-time counts and straight-line distances, so a
+            # date window or road distance is always exact)
+            if use_grid_for_clicks and call_window is None and not use_network_distance:
+                scores = cluster_surface.lookup(click_lng, click_lat)
+            else:
+                scores = scoring.score_click(
+                    click_lng, click_lat, window=call_window,
+                    network=transit_network if use_network_distance else None,
+                )
             
             # Store the counts in session state
-            st.session_state.custom_point_counts = nearby_counts
-            
-            # Calculate distance to nearest transit and main road
-            # Convert datasets to the same CRS for distance calculation
-            mainroads_3857 = mainroads.to_crs(epsg=3857)
-            transit_3857 = transit.to_crs(epsg=3857)
-            
-            # Calculate nearest transit distance
-            def calculate_nearest_distance(point_geom, target_geom):
-                nearest_geom = nearest_points(point_geom, target_geom.unary_union)[1]
-                return point_geom.distance(nearest_geom)
-            
-            # Calculate distances
-            transit_distance = calculate_nearest_distance(
-                custom_point_gdf.geometry[0], 
-                transit_3857.geometry
-            )
-            
-            # Calculate nearest road distance
-            road_distance = calculate_nearest_distance(
-                custom_point_gdf.geometry[0], 
-                mainroads_3857.geometry
-            )
+            st.session_state.custom_point_counts = {
+                column: int(scores[column]) for column in proximity.nearby_count_columns()
+            }
             
             # Store distances in session state
             st.session_state.custom_point_distances = {
-                'Nearest_Transit_Distance': transit_distance,
-                'Nearest_Road_Distance': road_distance
+                'Nearest_Transit_Distance': float(scores['Nearest_Transit_Distance']),
+                'Nearest_Road_Distance': float(scores['Nearest_Road_Distance'])
             }
             
-            # Prepare data for K-means classification
-            feature_values = [
-                nearby_counts['Nearby_Count_500'],
-                nearby_counts['Nearby_Count_1000'],
-                nearby_counts['Nearby_Count_2000'],
-                nearby_counts['Nearby_Count_3000'],
-                transit_distance,
-                road_distance
-            ]
-            
-            # Create a feature array for the custom point
-            features_array = np.array(feature_values).reshape(1, -1)
-            
-            # Standardize the data using the loaded scaler
-            standardized_features = std_scaler.transform(features_array)
-            
-            # Predict the cluster for the custom point
-            cluster_prediction = k_means.predict(standardized_features)[0]
-            
-            # Apply the same cluster remapping as in your original code
-            # Original: sites['Cluster'] = sites['Cluster'].replace({0: 1, 1: 2, 2: 1, 3: 3})
-            cluster_mapping = {0: 1, 1: 2, 2: 1, 3: 3}
-            remapped_cluster = cluster_mapping.get(cluster_prediction, cluster_prediction)
-            
             # Store the cluster in session state
-            st.session_state.custom_point_cluster = remapped_cluster
+            st.session_state.custom_point_cluster = int(scores['Cluster'])
             
 # Display site details in the right panel
 with col2:
@@ -404,7 +491,7 @@ with col2:
     
     if st.session_state.selected_site_id is not None:
         # Get the selected site
-        selected_site = sites.iloc[st.session_state.selected_site_id]
+        selected_site = sites.loc[st.session_state.selected_site_id]
         
         # Display the site details
         st.subheader(f"{selected_site['Type']} Site")
@@ -443,6 +530,30 @@ with col2:
             with cols[1]:
                 st.metric("Nearest Main Road (Meters)", f"{selected_site['Nearest_Road_Distance']:.1f}m")
         
+        with st.expander("Coverage", expanded=False):
+            coverage_tracker = get_coverage_tracker()
+            site_position = sites.index.get_loc(st.session_state.selected_site_id)
+            site_active = bool(coverage_tracker.active[site_position])
+            st.metric(
+                f"Calls Only This Site Covers ({placement_radius}m)" if site_active
+                else f"Calls This Site Would Add ({placement_radius}m)",
+                coverage_tracker.marginal(site_position)
+            )
+            st.caption(f"Included sites cover {coverage_tracker.covered} of {coverage_tracker.total} calls")
+            st.button(
+                "Exclude From Coverage" if site_active else "Include in Coverage",
+                on_click=toggle_site_coverage,
+                args=(st.session_state.selected_site_id,)
+            )
+        
+        # Only with the density layer on, a collapsed expander still runs its body
+        if show_density:
+            with st.expander("Call Density", expanded=False):
+                site_density = density.call_density_surface(window=call_window).sample(
+                    data_loader.project_points(selected_site.geometry.x, selected_site.geometry.y)
+                )[0]
+                st.metric("Calls per km²", f"{site_density:.1f}")
+        
         # Display coordinates
         with st.expander("Geospatial Information", expanded=False):
             st.markdown(f"**Latitude:** {selected_site.geometry.y:.6f}")
@@ -499,10 +610,32 @@ with col2:
                     st.metric("Nearest Main Road (Meters)", 
                              f"{st.session_state.custom_point_distances.get('Nearest_Road_Distance', 0):.1f}m")
         
+        with st.expander("Coverage", expanded=False):
+            coverage_tracker = get_coverage_tracker()
+            st.metric(
+                f"Uncovered Calls Within {placement_radius}m",
+                coverage_tracker.point_marginal(data_loader.project_points(lng, lat))
+            )
+            st.caption(f"Included sites cover {coverage_tracker.covered} of {coverage_tracker.total} calls")
+        
+        if show_density:
+            with st.expander("Call Density", expanded=False):
+                point_density = density.call_density_surface(window=call_window).sample(
+                    data_loader.project_points(lng, lat)
+                )[0]
+                st.metric("Calls per km²", f"{point_density:.1f}")
+        
         # Display coordinates again in an expandable section
         with st.expander("Geospatial Information", expanded=False):
             st.markdown(f"**Latitude:** {lat:.6f}")
             st.markdown(f"**Longitude:** {lng:.6f}")
+            
+            # Custom point results are cached across sessions
+            cache_stats = scoring.point_cache.stats()
+            st.caption(
+                f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                f"{cache_stats['size']} locations"
+            )
         
         # If we have the k-means result, show a custom marker on the map
         if 'custom_point_cluster' in st.session_state:
@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry.
+
+    Shared instances are safe to use from every Streamlit session; hit and
+    miss counts are kept for reporting.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def lookup(self, key, default=None, sources=()):
+        """Return the cached value (marking it recently used) or `default`.
+
+        An entry stored with different `sources` objects is a miss.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and _same_objects(entry[0], sources):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, sources=()):
+        with self._lock:
+            self._data[key] = (tuple(sources), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, build, sources=()):
+        """Return the cached value for `key`, calling build() on a miss.
+
+        Keys holding id() of a dataset or index pass those objects as
+        `sources`. The entry keeps them alive and only matches the very same
+        objects, so an id reused by a later object never finds a stale value.
+        """
+        missing = object()
+        value = self.lookup(key, missing, sources)
+        if value is missing:
+            value = build()
+            self.put(key, value, sources)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+def _same_objects(stored, sources):
+    return len(stored) == len(sources) and all(a is b for a, b in zip(stored, sources))
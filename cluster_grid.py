@@ -0,0 +1,156 @@
+"""Precompute the feature vector and K-means cluster over a county-wide grid.
+
+    python cluster_grid.py cluster_grid.npz --cell-size 250
+
+The grid is a regular raster in the metric CRS stored as a compressed
+.npz file. A click is answered by looking up its cell, which is O(1).
+"""
+import argparse
+import time
+
+import numpy as np
+
+import data_loader
+import scoring
+import site_features
+
+CLUSTER_GRID_PATH = 'cluster_grid.npz'
+
+PIERCE_COUNTY_BOUNDS = data_loader.PIERCE_COUNTY_BOUNDS
+
+# Number of cells scored per batch, bounding peak memory of the query
+CHUNK_SIZE = 20000
+
+
+class ClusterGrid:
+    """Regular metric-CRS grid of features and clusters evaluated at cell centres.
+
+    `model` is the fingerprint of the CentroidModel that assigned the clusters.
+    """
+
+    def __init__(self, origin, cell_size, features, clusters, crs=data_loader.METRIC_CRS, model=''):
+        self.origin = np.asarray(origin, dtype=float)
+        self.cell_size = float(cell_size)
+        self.features = features
+        self.clusters = clusters
+        self.crs = crs
+        self.model = model
+
+    @property
+    def shape(self):
+        return self.clusters.shape
+
+    def cell_index(self, xy):
+        """Return (rows, cols, inside) for metric x/y points."""
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        cols = np.floor((xy[:, 0] - self.origin[0]) / self.cell_size).astype(np.int64)
+        rows = np.floor((xy[:, 1] - self.origin[1]) / self.cell_size).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        return rows, cols, inside
+
+    def lookup(self, lng, lat, exact=False):
+        """Return a dict of features and Cluster for one location.
+
+        Points outside the grid, or any point when `exact` is set, are scored
+        exactly with the proximity indexes instead.
+        """
+        xy = data_loader.project_points(lng, lat)
+        rows, cols, inside = self.cell_index(xy)
+        if exact or not inside[0]:
+            scores = scoring.score_points(xy).iloc[0]
+            result = {column: float(scores[column]) for column in site_features.FEATURE_COLUMNS}
+            result['Cluster'] = int(scores['Cluster'])
+        else:
+            result = dict(zip(site_features.FEATURE_COLUMNS, self.features[rows[0], cols[0]].tolist()))
+            result['Cluster'] = int(self.clusters[rows[0], cols[0]])
+        return result
+
+    def bounds_lonlat(self):
+        """[[south, west], [north, east]] of the grid for map overlays."""
+        return data_loader.grid_bounds_lonlat(self.origin, self.cell_size, self.shape)
+
+    def save(self, path=CLUSTER_GRID_PATH):
+        np.savez_compressed(
+            path, origin=self.origin, cell_size=self.cell_size, crs=self.crs,
+            features=self.features, clusters=self.clusters, model=self.model,
+        )
+
+    @classmethod
+    def load(cls, path=CLUSTER_GRID_PATH):
+        with np.load(path) as data:
+            # Grids saved before the model was recorded load with an empty one
+            model = str(data['model']) if 'model' in data.files else ''
+            return cls(data['origin'], data['cell_size'], data['features'], data['clusters'], str(data['crs']), model)
+
+
+def build_grid(bounds=PIERCE_COUNTY_BOUNDS, cell_size=250.0, model=None, chunk_size=CHUNK_SIZE, workers=1):
+    """Score every cell centre inside the lon/lat `bounds`.
+
+    Chunks of cells are scored across `workers` processes (None for one per CPU).
+    """
+    model = model if model is not None else scoring.load_model()
+    corners = data_loader.project_points([bounds[0], bounds[2]], [bounds[1], bounds[3]])
+    origin = corners[0]
+    width = int(np.ceil((corners[1, 0] - corners[0, 0]) / cell_size))
+    height = int(np.ceil((corners[1, 1] - corners[0, 1]) / cell_size))
+
+    cols, rows = np.meshgrid(np.arange(width), np.arange(height))
+    centres = np.column_stack([
+        origin[0] + (cols.ravel() + 0.5) * cell_size,
+        origin[1] + (rows.ravel() + 0.5) * cell_size,
+    ])
+
+    scores = scoring.score_points_parallel(centres, model, workers, chunk_size)
+    features = scores[site_features.FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    clusters = scores['Cluster'].to_numpy().astype(np.uint8)
+
+    return ClusterGrid(
+        origin, cell_size,
+        features.reshape(height, width, -1), clusters.reshape(height, width),
+        model=getattr(model, 'fingerprint', ''),
+    )
+
+
+def load_grid(path=CLUSTER_GRID_PATH):
+    """Return the cached grid, or None when it is missing or stale.
+
+    A grid is stale when it was built for another metric CRS or its clusters
+    come from another model than scoring.load_model() (e.g. after
+    train_model.py wrote a new artifact).
+    """
+    try:
+        grid = data_loader.cached('cluster_grid', path, ClusterGrid.load)
+    except FileNotFoundError:
+        return None
+    if grid.crs != data_loader.METRIC_CRS or grid.model != scoring.load_model().fingerprint:
+        return None
+    return grid
+
+
+def cluster_image(grid, colors, opacity=0.45):
+    """RGBA image of the grid clusters (row 0 is the southern edge)."""
+    image = np.zeros(grid.shape + (4,), dtype=np.uint8)
+    for cluster, color in colors.items():
+        rgb = [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+        image[grid.clusters == cluster] = rgb + [int(opacity * 255)]
+    return image
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', default=CLUSTER_GRID_PATH)
+    parser.add_argument('--cell-size', type=float, default=250.0, help='Cell size in metric CRS units')
+    parser.add_argument('--bounds', type=float, nargs=4, default=PIERCE_COUNTY_BOUNDS,
+                        metavar=('MIN_LNG', 'MIN_LAT', 'MAX_LNG', 'MAX_LAT'))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    grid = build_grid(args.bounds, args.cell_size, workers=args.workers)
+    grid.save(args.output)
+    print(f'Wrote {grid.shape[0]}x{grid.shape[1]} grid to {args.output} in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pyproj import CRS, Transformer
+
+# Default locations of the datasets used by the app
+SITES_PATH = 'Sites_with_Clusters.geojson'
+CALLS_PATH = 'Overdose_zip_geocodio.csv'
+CALLS_PARQUET_PATH = 'Overdose_calls.parquet'
+MAINROADS_PATH = 'MainRoads.geojson'
+TRANSIT_PATH = 'Transit.geojson'
+KMEANS_PATH = 'kmeans_algo.pkl'
+MODEL_PATH = 'cluster_model.npz'
+
+# Columns identifying transit stops / main roads; the frame index is used
+# when a column is missing
+TRANSIT_ID_COLUMN = 'stopid'
+ROAD_ID_COLUMN = 'OBJECTID'
+
+# Geographic CRS used for display
+DISPLAY_CRS = 'EPSG:4326'
+
+# Approximate Pierce County extent (min lng, min lat, max lng, max lat)
+PIERCE_COUNTY_BOUNDS = (-122.85, 46.72, -121.40, 47.42)
+
+# UTM zone 10N, which measures true ground metres across Pierce County
+LOCAL_METRIC_CRS = 'EPSG:32610'
+
+
+def check_metric_crs(crs):
+    """Return `crs` if it is a projected CRS measured in metres, else raise ValueError."""
+    parsed = CRS.from_user_input(crs)
+    units = {axis.unit_name for axis in parsed.axis_info}
+    if not parsed.is_projected or units != {'metre'}:
+        raise ValueError(f'{crs} is not a projected CRS in metres, distances and radii would be wrong')
+    return crs
+
+
+# Metric CRS used for every distance, radius and grid cell, in the app and the
+# batch scripts alike. Web Mercator overstates lengths by ~1/cos(47°) ≈ 1.47
+# here, but the stored site features and the K-means model were computed in
+# it, so it stays the default. Set OD_METRIC_CRS (e.g. to LOCAL_METRIC_CRS)
+# for true ground distances, then rebuild the site features and the model.
+METRIC_CRS = check_metric_crs(os.environ.get('OD_METRIC_CRS', 'EPSG:3857'))
+
+# A loaded dataset in both the display CRS and the metric CRS. For point
+# layers `xy` holds the metric coordinates as an (N, 2) float array,
+# for line layers it is None. The calls are loaded as a CallsLayer instead.
+Layer = namedtuple('Layer', ['wgs84', 'metric', 'xy'])
+
+# Process-wide cache shared by every Streamlit session and batch job.
+# Entries are keyed on (kind, absolute path) and remember the file mtime
+# they were loaded from, so an edited file is picked up on the next call.
+# The lock is reentrant because a loader may itself load a cached file.
+_cache = {}
+_lock = threading.RLock()
+
+
+def cached(kind, path, loader):
+    """Return loader(path), reusing the previous result while the file is unchanged."""
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    key = (kind, path)
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        value = loader(path)
+        _cache[key] = (mtime, value)
+        return value
+
+
+def invalidate(path=None):
+    """Drop cached datasets, either for a single file or for everything."""
+    with _lock:
+        if path is None:
+            _cache.clear()
+            return
+        path = os.path.abspath(path)
+        for key in [key for key in _cache if key[1] == path]:
+            del _cache[key]
+
+
+def _to_layer(gdf):
+    gdf = gdf.to_crs(DISPLAY_CRS)
+    metric = gdf.to_crs(METRIC_CRS)
+    xy = None
+    if len(metric) and (metric.geom_type == 'Point').all():
+        xy = np.column_stack([metric.geometry.x.to_numpy(), metric.geometry.y.to_numpy()])
+        xy.setflags(write=False)
+    return Layer(gdf, metric, xy)
+
+
+def feature_ids(frame, column):
+    return frame[column].to_numpy() if column in frame.columns else frame.index.to_numpy()
+
+
+def _read_vector(path):
+    return _to_layer(gpd.read_file(path))
+
+
+# Columns of the calls extract used by the app; the date column is optional
+# and enables time-windowed counts
+CALLS_COLUMNS = ['Longitude', 'Latitude']
+CALLS_DATE_COLUMN = 'Date'
+
+
+# Marks CallsLayer times that have not been parsed yet (None means no date column)
+_NOT_PARSED = object()
+
+
+class CallsLayer:
+    """The calls as a plain table plus (N, 2) coordinate arrays.
+
+    `xy` holds the metric coordinates and `lonlat` the longitude/latitude.
+    Nothing on the hot paths needs a Shapely point per call, so the `wgs84`
+    and `metric` GeoDataFrames of the other layers are only built when first
+    used.
+    """
+
+    def __init__(self, table, xy):
+        self.table = table
+        self.lonlat = table[CALLS_COLUMNS].to_numpy(dtype=float)
+        self.lonlat.setflags(write=False)
+        self.xy = xy
+        self.xy.setflags(write=False)
+        self._frames = {}
+        self._times = _NOT_PARSED
+
+    def __len__(self):
+        return len(self.table)
+
+    def _frame(self, crs, coords):
+        if crs not in self._frames:
+            self._frames[crs] = gpd.GeoDataFrame(
+                self.table, geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs=crs,
+            )
+        return self._frames[crs]
+
+    @property
+    def times(self):
+        """call_times() of the table, parsed once per loaded file."""
+        if self._times is _NOT_PARSED:
+            self._times = call_times(self.table)
+        return self._times
+
+    @property
+    def wgs84(self):
+        return self._frame(DISPLAY_CRS, self.lonlat)
+
+    @property
+    def metric(self):
+        return self._frame(METRIC_CRS, self.xy)
+
+
+def _finite_calls(calls):
+    # Rows whose coordinates are blank or not numbers are never counted; a
+    # single NaN would stop the KD-tree from building, and a stray string
+    # would abort a whole ingest
+    calls[CALLS_COLUMNS] = calls[CALLS_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    finite = np.isfinite(calls[CALLS_COLUMNS].to_numpy(dtype=float)).all(axis=1)
+    return calls[finite].reset_index(drop=True)
+
+
+def _read_calls(path):
+    if path.endswith('.parquet'):
+        return _read_calls_parquet(path)
+    calls = _finite_calls(pd.read_csv(path))
+    return CallsLayer(calls, project_points(calls.Longitude.to_numpy(), calls.Latitude.to_numpy()))
+
+
+def _read_calls_parquet(path):
+    calls = pd.read_parquet(path)
+    if calls.attrs.get('metric_crs') != METRIC_CRS:
+        # Stored for another metric CRS, so reproject from longitude/latitude
+        calls[['x', 'y']] = project_points(calls.Longitude.to_numpy(), calls.Latitude.to_numpy())
+    return CallsLayer(calls.drop(columns=['x', 'y']), calls[['x', 'y']].to_numpy(dtype=float))
+
+
+def read_calls_table(path):
+    """Plain DataFrame of the call columns the app uses, from a CSV or Parquet file."""
+    if path.endswith('.parquet'):
+        calls = pd.read_parquet(path)
+        return calls[[column for column in calls.columns if column not in ('x', 'y')]]
+    header = pd.read_csv(path, nrows=0).columns
+    columns = CALLS_COLUMNS + ([CALLS_DATE_COLUMN] if CALLS_DATE_COLUMN in header else [])
+    calls = _finite_calls(pd.read_csv(path, usecols=columns))
+    if CALLS_DATE_COLUMN in calls.columns:
+        calls[CALLS_DATE_COLUMN] = pd.to_datetime(calls[CALLS_DATE_COLUMN], errors='coerce')
+    return calls
+
+
+def write_calls_parquet(calls, parquet_path=CALLS_PARQUET_PATH):
+    """Write a read_calls_table() frame, plus projected x/y, to a Parquet file."""
+    calls = calls.copy()
+    calls[['x', 'y']] = project_points(calls.Longitude.to_numpy(), calls.Latitude.to_numpy())
+    calls.attrs['metric_crs'] = METRIC_CRS
+    calls.to_parquet(parquet_path, index=False)
+    return len(calls)
+
+
+def convert_calls(csv_path=CALLS_PATH, parquet_path=CALLS_PARQUET_PATH):
+    """Write the columns the app uses, plus projected x/y, to a Parquet file.
+
+    Loading the Parquet file skips CSV parsing and the to_crs of every call.
+    """
+    return write_calls_parquet(read_calls_table(csv_path), parquet_path)
+
+
+def call_times(frame):
+    """datetime64[ns] array of call dates (NaT where unknown), or None without a date column."""
+    if CALLS_DATE_COLUMN not in frame.columns:
+        return None
+    return pd.to_datetime(frame[CALLS_DATE_COLUMN], errors='coerce').to_numpy(dtype='datetime64[ns]')
+
+
+def default_calls_path():
+    """The converted Parquet calls file when present, otherwise the CSV."""
+    return CALLS_PARQUET_PATH if os.path.exists(CALLS_PARQUET_PATH) else CALLS_PATH
+
+
+_transformers = {}
+
+
+def _transform(source, target, x, y):
+    transformer = _transformers.get((source, target))
+    if transformer is None:
+        transformer = Transformer.from_crs(source, target, always_xy=True)
+        _transformers[(source, target)] = transformer
+    x, y = transformer.transform(np.atleast_1d(np.asarray(x, dtype=float)),
+                                 np.atleast_1d(np.asarray(y, dtype=float)))
+    return np.column_stack([x, y])
+
+
+def project_points(lng, lat):
+    """Project longitude/latitude values into the metric CRS.
+
+    Accepts scalars or arrays and returns an (N, 2) array of x/y coordinates,
+    so a map click costs one coordinate transform instead of a dataset to_crs.
+    """
+    return _transform(DISPLAY_CRS, METRIC_CRS, lng, lat)
+
+
+def unproject_points(x, y):
+    """Inverse of project_points, returning an (N, 2) array of lng/lat."""
+    return _transform(METRIC_CRS, DISPLAY_CRS, x, y)
+
+
+def grid_bounds_lonlat(origin, cell_size, shape):
+    """[[south, west], [north, east]] of a metric-CRS grid of (rows, cols) `shape` cells."""
+    height, width = shape[:2]
+    corners = unproject_points(
+        [origin[0], origin[0] + width * cell_size],
+        [origin[1], origin[1] + height * cell_size],
+    )
+    return [[float(corners[0, 1]), float(corners[0, 0])], [float(corners[1, 1]), float(corners[1, 0])]]
+
+
+def load_sites(path=SITES_PATH):
+    return cached('sites', path, _read_vector)
+
+
+def load_calls(path=None):
+    return cached('calls', path or default_calls_path(), _read_calls)
+
+
+def load_mainroads(path=MAINROADS_PATH):
+    return cached('mainroads', path, _read_vector)
+
+
+def load_transit(path=TRANSIT_PATH):
+    return cached('transit', path, _read_vector)
+
+
+def load_kmeans(path=KMEANS_PATH):
+    """Return the (scaler, kmeans) pair stored in the K-means pickle."""
+    def read(path):
+        k_means_algo = pd.read_pickle(path)
+        return k_means_algo['scaler'], k_means_algo['kmeans']
+    return cached('kmeans', path, read)
+
+
+def load_cluster_model(path=MODEL_PATH):
+    """Return the arrays of a cluster model artifact written by train_model.py.
+
+    The artifact is a plain .npz file, read without pickle.
+    """
+    def read(path):
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    return cached('cluster_model', path, read)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the calls CSV to the Parquet format loaded by the app.')
+    parser.add_argument('csv', nargs='?', default=CALLS_PATH)
+    parser.add_argument('output', nargs='?', default=CALLS_PARQUET_PATH)
+    args = parser.parse_args(argv)
+    count = convert_calls(args.csv, args.output)
+    print(f'Wrote {count} calls to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Kernel density of calls, from binned counts convolved with a Gaussian by FFT.
+
+Calls are counted on a regular metric-CRS grid and the counts are convolved
+with the kernel sampled on the same grid, so the surface costs one FFT
+instead of a kernel evaluation per call per cell.
+"""
+import numpy as np
+
+import data_loader
+import proximity
+import shared_arrays
+from caching import LRUCache
+
+# Column holding the density sampled at a site or custom point
+DENSITY_COLUMN = 'Call_Density'
+
+# Gaussian kernel standard deviation and grid cell size, in metric CRS units
+BANDWIDTH = 500.0
+CELL_SIZE = 100.0
+
+# The kernel is cut off this many bandwidths from its centre
+TRUNCATE = 4.0
+
+# Upper limit on grid cells (~64 MB of float64); larger extents get coarser cells
+MAX_CELLS = 8_000_000
+
+# Surfaces keyed on the call coordinates and kernel settings, shared by all sessions
+surface_cache = LRUCache(maxsize=8)
+
+
+class DensitySurface:
+    """Call density in calls per km² on a regular metric-CRS grid.
+
+    density[row, col] is the value at the centre of the cell whose lower left
+    corner is origin + (col, row) * cell_size.
+    """
+
+    def __init__(self, origin, cell_size, density, bandwidth, crs=data_loader.METRIC_CRS):
+        self.origin = np.asarray(origin, dtype=float)
+        self.cell_size = float(cell_size)
+        self.density = density
+        self.bandwidth = float(bandwidth)
+        self.crs = crs
+
+    @property
+    def shape(self):
+        return self.density.shape
+
+    def sample(self, xy):
+        """Bilinearly interpolated density at metric x/y points (0 outside the grid)."""
+        # Imported on first use, scipy.ndimage and scipy.signal are slow to
+        # import and the app starts without a density surface
+        from scipy.ndimage import map_coordinates
+
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        cols = (xy[:, 0] - self.origin[0]) / self.cell_size - 0.5
+        rows = (xy[:, 1] - self.origin[1]) / self.cell_size - 0.5
+        return map_coordinates(self.density, [rows, cols], order=1, mode='constant', cval=0.0)
+
+    def bounds_lonlat(self):
+        """[[south, west], [north, east]] of the grid for map overlays."""
+        return data_loader.grid_bounds_lonlat(self.origin, self.cell_size, self.shape)
+
+
+def gaussian_kernel(bandwidth, cell_size, truncate=TRUNCATE):
+    """2D Gaussian sampled at cell offsets, normalised to a density per square metre."""
+    radius = int(np.ceil(truncate * bandwidth / cell_size))
+    offsets = np.arange(-radius, radius + 1) * cell_size
+    profile = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    return np.outer(profile, profile) / (2 * np.pi * bandwidth ** 2)
+
+
+def kde(xy, bandwidth=BANDWIDTH, cell_size=CELL_SIZE, bounds=data_loader.PIERCE_COUNTY_BOUNDS):
+    """DensitySurface of metric x/y call points.
+
+    Calls outside the lon/lat `bounds` (None for no limit) are left out, so a
+    single mis-geocoded call cannot stretch the grid across the globe. The
+    grid covers the remaining calls plus TRUNCATE bandwidths on every side,
+    so the density falls to ~0 at its edges. Cells are enlarged when the
+    grid would exceed MAX_CELLS.
+    """
+    from scipy.signal import fftconvolve
+
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    xy = xy[np.isfinite(xy).all(axis=1)]
+    if bounds is not None:
+        corners = data_loader.project_points([bounds[0], bounds[2]], [bounds[1], bounds[3]])
+        xy = xy[((xy >= corners[0]) & (xy <= corners[1])).all(axis=1)]
+    if len(xy) == 0:
+        return DensitySurface((0.0, 0.0), cell_size, np.zeros((1, 1)), bandwidth)
+    padding = TRUNCATE * bandwidth
+    origin = xy.min(axis=0) - padding
+    extent = xy.max(axis=0) + padding - origin
+    cell_size = max(cell_size, float(np.sqrt(extent.prod() / MAX_CELLS)))
+    width, height = np.ceil(extent / cell_size).astype(int)
+    counts, _, _ = np.histogram2d(
+        xy[:, 1], xy[:, 0], bins=(height, width),
+        range=[[origin[1], origin[1] + height * cell_size], [origin[0], origin[0] + width * cell_size]],
+    )
+    density = fftconvolve(counts, gaussian_kernel(bandwidth, cell_size), mode='same')
+    # FFT round-off leaves tiny negative values where there are no calls
+    density = np.clip(density, 0.0, None) * 1e6
+    return DensitySurface(origin, cell_size, density.astype(np.float32), bandwidth)
+
+
+def _default_calls_xy():
+    shared = shared_arrays.open_shared()
+    return shared.calls_xy if shared is not None else data_loader.load_calls().xy
+
+
+def call_density_surface(xy=None, bandwidth=BANDWIDTH, cell_size=CELL_SIZE, window=None):
+    """Cached DensitySurface of the calls (the default dataset when `xy` is None).
+
+    With a (start, end) date `window` only the default dataset's calls dated
+    start <= date < end are used.
+    """
+    if window is not None:
+        temporal = proximity.temporal_call_index()
+        return surface_cache.get(
+            (id(temporal), window, bandwidth, cell_size),
+            lambda: kde(temporal.window_xy(*window), bandwidth, cell_size),
+            sources=(temporal,),
+        )
+    xy = xy if xy is not None else _default_calls_xy()
+    return surface_cache.get((id(xy), len(xy), bandwidth, cell_size), lambda: kde(xy, bandwidth, cell_size),
+                             sources=(xy,))
+
+
+def density_image(surface, max_size=1024, opacity=0.7):
+    """RGBA image of a DensitySurface (row 0 is the southern edge).
+
+    Low densities fade to transparent; the colour ramps from yellow to red
+    up to the 99.5th percentile of the non-zero cells. Large grids are
+    strided down to at most `max_size` pixels on a side.
+    """
+    step = max(1, int(np.ceil(max(surface.shape) / max_size)))
+    density = surface.density[::step, ::step]
+    nonzero = density[density > 0]
+    top = np.percentile(nonzero, 99.5) if len(nonzero) else 1.0
+    level = np.clip(density / top, 0.0, 1.0)[..., None]
+    low, high = np.array([255, 237, 160]), np.array([189, 0, 38])
+    image = np.empty(density.shape + (4,), dtype=np.uint8)
+    image[..., :3] = (low + (high - low) * level).astype(np.uint8)
+    image[..., 3] = (255 * opacity * level[..., 0]).astype(np.uint8)
+    return image
@@ -0,0 +1,148 @@
+"""Append a batch of new calls and update only the affected site counts.
+
+    python ingest_calls.py new_calls.csv [--publish]
+
+Each run writes a new versioned snapshot (snapshots/v0001, v0002, ...)
+holding the updated sites GeoJSON and the combined calls Parquet file.
+Only sites within the largest radius of a new call are touched. Running
+apps rebuild their call indexes from the published files on the next rerun,
+and exported shared arrays are refreshed by --publish.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.spatial import cKDTree
+
+import data_loader
+import proximity
+import scoring
+import shared_arrays
+import site_features
+
+SNAPSHOT_DIR = 'snapshots'
+LATEST_NAME = 'LATEST'
+
+
+def add_call_counts(sites_xy, counts, new_xy, radii=proximity.NEARBY_RADII):
+    """Add the new calls to an (N, len(radii)) count array in place.
+
+    Returns the positions of the sites whose counts changed.
+    """
+    sites_xy = np.asarray(sites_xy, dtype=float).reshape(-1, 2)
+    new_xy = np.asarray(new_xy, dtype=float).reshape(-1, 2)
+    if len(sites_xy) == 0 or len(new_xy) == 0:
+        return np.array([], dtype=np.int64)
+    neighbours = cKDTree(sites_xy).query_ball_point(new_xy, r=max(radii))
+    lengths = np.array([len(idx) for idx in neighbours])
+    if lengths.sum() == 0:
+        return np.array([], dtype=np.int64)
+    call_positions = np.repeat(np.arange(len(new_xy)), lengths)
+    site_positions = np.concatenate([idx for idx in neighbours if idx]).astype(np.int64)
+    offsets = sites_xy[site_positions] - new_xy[call_positions]
+    distances = np.hypot(offsets[:, 0], offsets[:, 1])
+    for j, radius in enumerate(radii):
+        np.add.at(counts[:, j], site_positions[distances <= radius], 1)
+    return np.unique(site_positions)
+
+
+def latest_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """Path of the most recent snapshot, or None when there is none yet."""
+    latest = os.path.join(snapshot_dir, LATEST_NAME)
+    if not os.path.exists(latest):
+        return None
+    with open(latest) as f:
+        return os.path.join(snapshot_dir, f.read().strip())
+
+
+def ingest(new_calls_path, snapshot_dir=SNAPSHOT_DIR, model=None):
+    """Append new calls to the latest snapshot (or the app's data) and write the next one.
+
+    Returns (snapshot path, number of sites updated).
+    """
+    model = model if model is not None else scoring.load_model()
+    base = latest_snapshot(snapshot_dir)
+    if base is not None:
+        sites = gpd.read_file(os.path.join(base, 'sites.geojson'))
+        calls = data_loader.read_calls_table(os.path.join(base, 'calls.parquet'))
+    else:
+        sites = gpd.read_file(data_loader.SITES_PATH)
+        calls = data_loader.read_calls_table(data_loader.default_calls_path())
+    sites = sites.to_crs(data_loader.DISPLAY_CRS)
+    new_calls = data_loader.read_calls_table(new_calls_path)
+
+    # Update the counts of the sites near a new call, then their clusters
+    count_columns = proximity.nearby_count_columns()
+    counts = sites[count_columns].to_numpy(dtype=np.int64)
+    new_xy = data_loader.project_points(new_calls.Longitude.to_numpy(), new_calls.Latitude.to_numpy())
+    affected = add_call_counts(site_features.point_xy(sites), counts, new_xy)
+    sites[count_columns] = counts
+    if len(affected):
+        clusters = sites['Cluster'].to_numpy().copy()
+        clusters[affected] = model.predict(sites.iloc[affected])
+        sites['Cluster'] = clusters
+
+    # Write the next versioned snapshot; LATEST is updated last
+    versions = [int(name[1:]) for name in os.listdir(snapshot_dir)
+                if name.startswith('v') and name[1:].isdigit()] if os.path.isdir(snapshot_dir) else []
+    version = f'v{max(versions, default=0) + 1:04d}'
+    path = os.path.join(snapshot_dir, version)
+    os.makedirs(path)
+    sites.to_file(os.path.join(path, 'sites.geojson'), driver='GeoJSON')
+    data_loader.write_calls_parquet(
+        pd.concat([calls, new_calls], ignore_index=True), os.path.join(path, 'calls.parquet')
+    )
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump({
+            'parent': os.path.basename(base) if base else None,
+            'new_calls': os.path.abspath(new_calls_path),
+            'new_call_count': len(new_calls),
+            'sites_updated': int(len(affected)),
+            'created': pd.Timestamp.now().isoformat(),
+        }, f, indent=2)
+    with open(os.path.join(snapshot_dir, LATEST_NAME), 'w') as f:
+        f.write(version)
+    return path, len(affected)
+
+
+def publish(snapshot, sites_path=data_loader.SITES_PATH, calls_path=data_loader.CALLS_PARQUET_PATH,
+            shared_dir=shared_arrays.SHARED_ARRAYS_DIR):
+    """Replace the app's sites and calls files with a snapshot's.
+
+    Files are swapped with an atomic rename; running apps pick them up on the
+    next rerun through the loader's mtime check. Shared arrays exported to
+    `shared_dir` are re-exported from the new calls, otherwise every worker
+    would find them stale and fall back to its own copy. Returns whether they
+    were.
+    """
+    for source, target in [('sites.geojson', sites_path), ('calls.parquet', calls_path)]:
+        with open(os.path.join(snapshot, source), 'rb') as src, open(target + '.tmp', 'wb') as dst:
+            dst.write(src.read())
+        os.replace(target + '.tmp', target)
+    if not os.path.exists(os.path.join(shared_dir, shared_arrays.MANIFEST_NAME)):
+        return False
+    shared_arrays.export(shared_dir, calls_path)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('new_calls', help='CSV or Parquet file of new calls')
+    parser.add_argument('--snapshots', default=SNAPSHOT_DIR)
+    parser.add_argument('--publish', action='store_true',
+                        help='Also replace the sites and calls files loaded by the app')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    path, updated = ingest(args.new_calls, args.snapshots)
+    shared = args.publish and publish(path)
+    print(f'Wrote {path}, {updated} sites updated{", shared arrays re-exported" if shared else ""} '
+          f'in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+import folium
+from folium.plugins import FastMarkerCluster, HeatMap
+
+from caching import LRUCache
+
+# Ways the call points can be drawn on the map
+CALL_RENDER_MODES = ('Points', 'Clustered', 'Heatmap')
+
+# Default cap on the number of call points sent to the browser
+MAX_CALL_POINTS = 20000
+
+# Decimal places kept for coordinates sent to the browser (~1m precision)
+COORDINATE_PRECISION = 5
+
+# Layer payloads (GeoJSON dicts / coordinate lists) shared by all sessions.
+# Keys start with id() of the source frame, and each entry holds on to that
+# frame so the id cannot be taken over by a later one while it is cached.
+layer_cache = LRUCache(maxsize=64)
+
+
+def lonlat_array(gdf):
+    """(N, 2) array of longitude/latitude for a point GeoDataFrame in EPSG:4326.
+
+    An (N, 2) longitude/latitude array is returned unchanged.
+    """
+    if isinstance(gdf, np.ndarray):
+        return gdf
+    return np.column_stack([gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()])
+
+
+def sample_points(lonlat, cap, seed=0):
+    """Return at most `cap` rows of `lonlat`, sampled reproducibly."""
+    if cap is None or len(lonlat) <= cap:
+        return lonlat
+    rng = np.random.default_rng(seed)
+    keep = np.sort(rng.choice(len(lonlat), size=int(cap), replace=False))
+    return lonlat[keep]
+
+
+def points_geojson(lonlat):
+    """Compact GeoJSON of bare points as a single MultiPoint feature.
+
+    Leaflet still calls pointToLayer for every coordinate, so each point gets
+    its own circle marker without a per-point Feature wrapper in the payload.
+    """
+    return {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'properties': {},
+            'geometry': {'type': 'MultiPoint', 'coordinates': np.round(lonlat, COORDINATE_PRECISION).tolist()},
+        }],
+    }
+
+
+def calls_layer(calls, mode='Points', cap=MAX_CALL_POINTS, name="Service Calls"):
+    """Return a single folium layer drawing the call points.
+
+    `calls` is a longitude/latitude array (the calls layer's or the shared one)
+    or a point GeoDataFrame.
+
+    'Points' ships one GeoJSON layer drawn as canvas circle markers (the map
+    should be created with prefer_canvas=True), 'Clustered' uses
+    FastMarkerCluster and 'Heatmap' a HeatMap. At most `cap` calls are drawn.
+    """
+    if mode in ('Clustered', 'Heatmap'):
+        latlon = layer_cache.get(('calls_latlon', id(calls), cap), lambda: np.round(
+            sample_points(lonlat_array(calls), cap)[:, ::-1], COORDINATE_PRECISION
+        ).tolist(), sources=(calls,))
+        if mode == 'Clustered':
+            return FastMarkerCluster(latlon, name=name)
+        return HeatMap(latlon, name=name, radius=10)
+    return folium.GeoJson(
+        layer_cache.get(('calls_geojson', id(calls), cap), lambda: points_geojson(
+            sample_points(lonlat_array(calls), cap)
+        ), sources=(calls,)),
+        name=name,
+        marker=folium.CircleMarker(
+            radius=2,  # smaller than site markers
+            color='black',
+            fill=True,
+            fill_color='black',
+            fill_opacity=0.4,
+            opacity=0.4,
+        ),
+    )
+
+
+def highlighted_sites(sites, selected_clusters=None, nearby_1000_threshold=0, nearby_3000_threshold=0):
+    """Boolean array marking the sites that pass the sidebar filters.
+
+    A site is highlighted when it is in one of the selected clusters (or no
+    cluster is selected) and meets both proximity thresholds.
+    """
+    is_cluster_highlighted = sites['Cluster'].isin(selected_clusters) if selected_clusters else True
+    meets_proximity_criteria = (
+        (sites['Nearby_Count_1000'] >= nearby_1000_threshold) &
+        (sites['Nearby_Count_3000'] >= nearby_3000_threshold)
+    )
+    return (is_cluster_highlighted & meets_proximity_criteria).to_numpy()
+
+
+def site_marker_styles(sites, colors, selected_clusters=None,
+                       nearby_1000_threshold=0, nearby_3000_threshold=0):
+    """Return marker_color/marker_opacity/marker_radius columns for every site."""
+    is_highlighted = highlighted_sites(sites, selected_clusters, nearby_1000_threshold, nearby_3000_threshold)
+    return pd.DataFrame({
+        'marker_color': sites['Cluster'].map(colors).to_numpy(),
+        'marker_opacity': np.where(is_highlighted, 1.0, 0.2),
+        'marker_radius': np.where(is_highlighted, 8, 6),
+    }, index=sites.index)
+
+
+def site_tooltips(sites):
+    """Tooltip HTML for every site, built column-wise."""
+    return (
+        '<div style="font-family: Arial; font-size: 12px;"><b>' + sites['Type'].astype(str) + '</b><br>'
+        + sites['Address'].astype(str) + ', ' + sites['City'].astype(str) + '<br>'
+        + 'Cluster: ' + sites['Cluster'].astype(str) + '</div>'
+    )
+
+
+def sites_geojson(sites, styles):
+    """GeoJSON of site points carrying their id, tooltip and marker style."""
+    lonlat = np.round(lonlat_array(sites), 7).tolist()
+    properties = pd.DataFrame({
+        'site_id': sites.index.to_numpy(),
+        'tooltip': site_tooltips(sites).to_numpy(),
+        'marker_color': styles['marker_color'].to_numpy(),
+        'marker_opacity': styles['marker_opacity'].to_numpy(),
+        'marker_radius': styles['marker_radius'].to_numpy(),
+    }).to_dict('records')
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'id': str(props['site_id']), 'properties': props,
+             'geometry': {'type': 'Point', 'coordinates': point}}
+            for point, props in zip(lonlat, properties)
+        ],
+    }
+
+
+def _site_style(feature):
+    props = feature['properties']
+    return {
+        'color': props['marker_color'],
+        'fillColor': props['marker_color'],
+        'fillOpacity': props['marker_opacity'],
+        'opacity': props['marker_opacity'],
+        'radius': props['marker_radius'],
+    }
+
+
+def sites_layer(data, name):
+    """Single GeoJSON layer of site circle markers built from sites_geojson().
+
+    Styles are grouped into a handful of shared cases by folium, and clicks
+    are reported through the feature (its `site_id` property) rather than a
+    per-marker script. A cluster without sites gets an empty FeatureGroup,
+    which keeps its layer control entry (GeoJsonTooltip needs a feature).
+    """
+    if not data['features']:
+        return folium.FeatureGroup(name=name)
+    return folium.GeoJson(
+        data,
+        name=name,
+        marker=folium.CircleMarker(fill=True),
+        style_function=_site_style,
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False),
+    )
+
+
+def site_layers(sites, colors, selected_clusters=None, nearby_1000_threshold=0, nearby_3000_threshold=0):
+    """Return {cluster: GeoJson layer} for the current filter values.
+
+    The GeoJSON payloads are memoized on the filter values, so a rerun with
+    unchanged filters only wraps cached data in new folium layers.
+    """
+    filter_key = (
+        id(sites), tuple(sorted(colors.items())), tuple(sorted(selected_clusters or [])),
+        nearby_1000_threshold, nearby_3000_threshold,
+    )
+
+    def build():
+        styles = site_marker_styles(sites, colors, selected_clusters, nearby_1000_threshold, nearby_3000_threshold)
+        payloads = {}
+        for cluster_id in colors:
+            cluster_mask = sites['Cluster'] == cluster_id
+            payloads[cluster_id] = sites_geojson(sites[cluster_mask], styles[cluster_mask])
+        return payloads
+
+    payloads = layer_cache.get(('sites',) + filter_key, build, sources=(sites,))
+    return {
+        cluster_id: sites_layer(data, f"Cluster {cluster_id} Sites")
+        for cluster_id, data in payloads.items()
+    }
+
+
+def chosen_sites_layer(sites, name="Chosen Sites"):
+    """Rings drawn around the sites picked by the placement solver."""
+    return folium.GeoJson(
+        points_geojson(lonlat_array(sites)),
+        name=name,
+        marker=folium.CircleMarker(
+            radius=13,
+            color='#d62728',
+            weight=3,
+            fill=False,
+        ),
+    )
@@ -0,0 +1,321 @@
+"""Choose the K candidate sites that together cover the most calls.
+
+    python placement.py candidates.geojson -k 5 --radius 1000 \
+        --existing Sites_with_Clusters.geojson --ilp --output chosen.geojson
+
+This is the maximal coverage location problem. A sparse candidate x call
+coverage matrix is built from the call KD-tree, and a lazy-greedy solver
+picks the sites. Coverage only shrinks as sites are added, so a stale gain
+is an upper bound and most candidates are never re-evaluated. The greedy
+answer is within (1 - 1/e) of the optimum; an integer program can refine
+and prove it.
+"""
+import argparse
+import heapq
+import time
+from collections import namedtuple
+
+import numpy as np
+import geopandas as gpd
+from scipy.sparse import csr_matrix, hstack, identity
+
+import data_loader
+import proximity
+import site_features
+from caching import LRUCache
+
+# Default coverage radius (metric CRS units)
+COVERAGE_RADIUS = 1000
+
+# Seconds the integer program may run before the best solution found is used
+ILP_TIME_LIMIT = 60
+
+# Coverage matrices keyed on the candidate frame, radius and date window
+coverage_cache = LRUCache(maxsize=16)
+
+# `selected` holds candidate positions in pick order and `gains` the calls
+# each one newly covers. `covered` counts every covered call, including those
+# of the fixed sites; `optimal` is True when the integer program proved it.
+Placement = namedtuple('Placement', ['selected', 'gains', 'covered', 'total', 'optimal'])
+
+
+def coverage_calls(window=None):
+    """CallIndex whose calls are the columns of coverage matrices.
+
+    With a (start, end) date `window` only the calls dated start <= date < end
+    are included.
+    """
+    if window is None:
+        return proximity.call_index()
+    temporal = proximity.temporal_call_index()
+    return coverage_cache.get(
+        ('calls', id(temporal), window), lambda: proximity.CallIndex(temporal.window_xy(*window)),
+        sources=(temporal,),
+    )
+
+
+def coverage_matrix(candidates_xy, radius=COVERAGE_RADIUS, window=None, calls=None):
+    """Sparse boolean (candidates, calls) matrix of the calls within `radius`."""
+    calls = calls if calls is not None else coverage_calls(window)
+    return calls.coverage(candidates_xy, radius)
+
+
+class CoverageTracker:
+    """Calls covered by a set of active sites, and the calls each site alone covers.
+
+    `cover_count[call]` is the number of active sites within reach of a call
+    and `unique[site]` the number of calls no other active site reaches.
+    Adding or removing a site only touches its own calls and the other
+    sites reaching them, never the whole site x call matrix.
+    """
+
+    def __init__(self, coverage, active=None, calls=None, radius=COVERAGE_RADIUS):
+        self.sites = csr_matrix(coverage)
+        self.calls_of = self.sites.tocsc()
+        self.calls = calls
+        self.radius = radius
+        n_sites, n_calls = self.sites.shape
+        self.active = np.zeros(n_sites, dtype=bool)
+        self.active[np.arange(n_sites) if active is None else np.asarray(active, dtype=np.int64)] = True
+        # Bulk start: counts and unique coverage in two sparse products
+        self.cover_count = np.asarray(self.sites.T.astype(np.int32) @ self.active.astype(np.int32)).ravel()
+        self.unique = np.asarray(self.sites.astype(np.int64) @ (self.cover_count == 1)).ravel()
+        self.unique[~self.active] = 0
+
+    def _calls(self, site):
+        return self.sites.indices[self.sites.indptr[site]:self.sites.indptr[site + 1]]
+
+    def _active_sites_of(self, calls):
+        # Active sites reaching each of `calls` (one entry per call/site pair)
+        starts = self.calls_of.indptr[calls]
+        lengths = self.calls_of.indptr[calls + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        sites = self.calls_of.indices[positions]
+        return sites[self.active[sites]]
+
+    def add(self, site):
+        if self.active[site]:
+            return
+        calls = self._calls(site)
+        counts = self.cover_count[calls]
+        # Calls held by exactly one site stop being unique to it
+        np.subtract.at(self.unique, self._active_sites_of(calls[counts == 1]), 1)
+        self.unique[site] = np.count_nonzero(counts == 0)
+        self.cover_count[calls] += 1
+        self.active[site] = True
+
+    def remove(self, site):
+        if not self.active[site]:
+            return
+        calls = self._calls(site)
+        self.cover_count[calls] -= 1
+        self.active[site] = False
+        self.unique[site] = 0
+        # Calls left with one site become unique to it
+        np.add.at(self.unique, self._active_sites_of(calls[self.cover_count[calls] == 1]), 1)
+
+    def toggle(self, site):
+        if self.active[site]:
+            self.remove(site)
+        else:
+            self.add(site)
+
+    def marginal(self, site):
+        """Calls only this site covers (if active) or that it would newly cover (if not)."""
+        if self.active[site]:
+            return int(self.unique[site])
+        return int(np.count_nonzero(self.cover_count[self._calls(site)] == 0))
+
+    def point_marginal(self, xy):
+        """Calls within the radius of a metric x/y point that no active site covers."""
+        calls = self.calls.coverage(xy, self.radius).indices
+        return int(np.count_nonzero(self.cover_count[calls] == 0))
+
+    @property
+    def covered(self):
+        return int(np.count_nonzero(self.cover_count))
+
+    @property
+    def total(self):
+        return self.sites.shape[1]
+
+
+def site_tracker(sites, radius=COVERAGE_RADIUS, window=None, active=None):
+    """CoverageTracker of `sites` over the cached coverage matrix."""
+    return CoverageTracker(cached_coverage(sites, radius, window), active, coverage_calls(window), radius)
+
+
+def greedy(coverage, k, fixed=()):
+    """Lazy-greedy choice of up to `k` rows of `coverage` covering the most columns.
+
+    Rows in `fixed` (e.g. existing sites) are taken first and do not count
+    towards `k`. Picking stops early once no row adds coverage.
+    Returns (selected rows, gains, covered column mask).
+    """
+    coverage = csr_matrix(coverage)
+    indptr, indices = coverage.indptr, coverage.indices
+    covered = np.zeros(coverage.shape[1], dtype=bool)
+    fixed = set(int(row) for row in fixed)
+    for row in fixed:
+        covered[indices[indptr[row]:indptr[row + 1]]] = True
+
+    # Heap of (-upper bound on the gain, row); ties go to the lower row
+    heap = [(-int(count), row) for row, count in enumerate(np.diff(indptr)) if row not in fixed]
+    heapq.heapify(heap)
+    selected, gains = [], []
+    while heap and len(selected) < k:
+        _, row = heapq.heappop(heap)
+        cols = indices[indptr[row]:indptr[row + 1]]
+        gain = int(np.count_nonzero(~covered[cols]))
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, row))
+            continue
+        if gain == 0:
+            break
+        covered[cols] = True
+        selected.append(row)
+        gains.append(gain)
+    return selected, gains, covered
+
+
+def refine_ilp(coverage, k, fixed=(), time_limit=ILP_TIME_LIMIT):
+    """Rows chosen by an exact integer program, as (rows, proven optimal).
+
+    Calls covered by the same set of candidates are merged into one weighted
+    variable, which keeps the program small. Returns None when the solver
+    finds no solution within `time_limit` seconds.
+    """
+    # scipy.optimize is slow to import and only needed here, so the app
+    # does not pay for it at startup
+    from scipy.optimize import Bounds, LinearConstraint, milp
+
+    coverage = csr_matrix(coverage)
+    fixed = np.asarray(sorted(set(int(row) for row in fixed)), dtype=np.int64)
+    free = np.setdiff1d(np.arange(coverage.shape[0]), fixed)
+    already = np.zeros(coverage.shape[1], dtype=bool)
+    if len(fixed):
+        already = np.asarray(coverage[fixed].sum(axis=0)).ravel() > 0
+    reachable = np.asarray(coverage[free].sum(axis=0)).ravel() > 0
+    candidates = coverage[free][:, np.flatnonzero(reachable & ~already)].tocsc()
+    if len(free) == 0 or candidates.shape[1] == 0:
+        return [], True
+
+    # Merge calls with identical candidate sets
+    groups = {}
+    for col in range(candidates.shape[1]):
+        key = candidates.indices[candidates.indptr[col]:candidates.indptr[col + 1]].tobytes()
+        groups.setdefault(key, []).append(col)
+    columns = [cols[0] for cols in groups.values()]
+    weights = np.array([len(cols) for cols in groups.values()], dtype=float)
+    merged = candidates[:, columns].astype(float)
+
+    # Variables: x (one per free candidate) then y (one per call group);
+    # y_g <= sum of the x covering group g, and exactly min(k, free) x are chosen
+    n_free, n_groups = len(free), len(columns)
+    cover = LinearConstraint(hstack([-merged.T, identity(n_groups)]), -np.inf, 0)
+    count = LinearConstraint(np.concatenate([np.ones(n_free), np.zeros(n_groups)])[None, :],
+                             min(k, n_free), min(k, n_free))
+    result = milp(
+        np.concatenate([np.zeros(n_free), -weights]),
+        constraints=[cover, count],
+        integrality=np.concatenate([np.ones(n_free), np.zeros(n_groups)]),
+        bounds=Bounds(0, 1),
+        options={'time_limit': time_limit},
+    )
+    if result.x is None:
+        return None
+    return free[np.round(result.x[:n_free]) == 1].tolist(), result.status == 0
+
+
+def solve(coverage, k, fixed=(), ilp=False, time_limit=ILP_TIME_LIMIT):
+    """Return a Placement of up to `k` rows of a coverage matrix.
+
+    The lazy-greedy answer is used unless `ilp` is set and the integer
+    program covers more calls.
+    """
+    coverage = csr_matrix(coverage)
+    fixed = list(fixed)
+    selected, gains, covered = greedy(coverage, k, fixed)
+    optimal = False
+    if ilp:
+        refined = refine_ilp(coverage, k, fixed, time_limit)
+        if refined is not None:
+            rows, optimal = refined
+            # Order the rows by marginal gain, as greedy would report them
+            order, order_gains, order_covered = greedy(coverage[rows + fixed], len(rows),
+                                                       fixed=range(len(rows), len(rows) + len(fixed)))
+            if order_covered.sum() >= covered.sum():
+                selected, gains, covered = [rows[i] for i in order], order_gains, order_covered
+    return Placement(selected, gains, int(covered.sum()), coverage.shape[1], optimal)
+
+
+def place_sites(candidates, k, radius=COVERAGE_RADIUS, window=None, existing=None, ilp=False,
+                time_limit=ILP_TIME_LIMIT):
+    """Choose up to `k` rows of a candidate point GeoDataFrame.
+
+    Calls already covered by an `existing` GeoDataFrame of sites count as
+    covered. Returns (chosen rows of `candidates` with a Calls_Covered
+    column of their marginal gains, Placement).
+    """
+    xy = site_features.point_xy(candidates)
+    if existing is not None and len(existing):
+        xy = np.vstack([xy, site_features.point_xy(existing)])
+    coverage = coverage_matrix(xy, radius, window)
+    placement = solve(coverage, k, fixed=range(len(candidates), len(xy)), ilp=ilp, time_limit=time_limit)
+    chosen = candidates.iloc[placement.selected].copy()
+    chosen['Calls_Covered'] = placement.gains
+    return chosen, placement
+
+
+def cached_coverage(sites, radius=COVERAGE_RADIUS, window=None):
+    """Coverage matrix of every row of `sites`, shared by all sessions."""
+    calls = coverage_calls(window)
+    return coverage_cache.get(
+        (id(sites), id(calls), len(calls), radius),
+        lambda: coverage_matrix(site_features.point_xy(sites), radius, calls=calls),
+        sources=(sites, calls),
+    )
+
+
+def marginal_coverage(sites, radius=COVERAGE_RADIUS, window=None):
+    """Calls within `radius` of each site that no other site in `sites` reaches."""
+    return CoverageTracker(coverage_matrix(site_features.point_xy(sites), radius, window)).unique
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('candidates', help='Candidate sites (any format geopandas can read)')
+    parser.add_argument('-k', type=int, default=5, help='Number of sites to choose')
+    parser.add_argument('--radius', type=float, default=COVERAGE_RADIUS)
+    parser.add_argument('--existing', help='Sites already in place; the calls they cover are not counted')
+    parser.add_argument('--ilp', action='store_true', help='Refine the greedy choice with an integer program')
+    parser.add_argument('--time-limit', type=float, default=ILP_TIME_LIMIT)
+    parser.add_argument('--output', help='GeoJSON file for the chosen (or, with --marginal, all) sites')
+    parser.add_argument('--marginal', action='store_true',
+                        help='Instead of choosing, report the calls each candidate alone covers')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    candidates = gpd.read_file(args.candidates).to_crs(data_loader.DISPLAY_CRS)
+    if args.marginal:
+        candidates['Unique_Calls_Covered'] = marginal_coverage(candidates, args.radius)
+        if args.output:
+            candidates.to_file(args.output, driver='GeoJSON')
+        for site_id, unique in candidates['Unique_Calls_Covered'].items():
+            print(f'{site_id}\t{unique}')
+        print(f'Marginal coverage of {len(candidates)} sites in {time.perf_counter() - start:.2f}s')
+        return
+    existing = gpd.read_file(args.existing).to_crs(data_loader.DISPLAY_CRS) if args.existing else None
+    chosen, placement = place_sites(candidates, args.k, args.radius, existing=existing,
+                                    ilp=args.ilp, time_limit=args.time_limit)
+    if args.output:
+        chosen.to_file(args.output, driver='GeoJSON')
+    for site_id, gain in zip(chosen.index, chosen['Calls_Covered']):
+        print(f'{site_id}\t{gain}')
+    quality = 'optimal' if placement.optimal else 'greedy' if not args.ilp else 'best found'
+    print(f'{placement.covered} of {placement.total} calls within {args.radius:g} covered ({quality}) '
+          f'in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
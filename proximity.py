@@ -0,0 +1,343 @@
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from shapely import STRtree, points as make_points
+
+import data_loader
+import shared_arrays
+
+# Radii (in metric CRS units) used for the Nearby_Count_* features
+NEARBY_RADII = (500, 1000, 2000, 3000)
+
+# Above this many query points CallIndex counts each radius separately
+BATCH_THRESHOLD = 256
+
+
+def nearby_count_columns(radii=NEARBY_RADII):
+    return [f'Nearby_Count_{radius}' for radius in radii]
+
+
+class CallIndex:
+    """KD-tree over projected call coordinates.
+
+    All radii are answered from a single ball query at the largest radius:
+    the neighbour distances are sorted once and every radius is a
+    searchsorted into that array.
+    """
+
+    def __init__(self, xy):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.tree = cKDTree(self.xy)
+
+    def __len__(self):
+        return len(self.xy)
+
+    def count_within(self, points, radii=NEARBY_RADII):
+        """Return an (N, len(radii)) array of call counts around each point."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        radii = np.asarray(radii, dtype=float)
+        return _count_within(self.tree, self.xy, points, radii)
+
+    def coverage(self, points, radius):
+        """Sparse boolean (N, len(self)) matrix of the calls within `radius` of each point.
+
+        Columns follow the order of the indexed calls.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        rows, cols = _pairs_within(self.tree, points, radius)
+        return csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(points), len(self)))
+
+
+def _pairs_within(tree, points, radius):
+    # (point, call) position pairs closer than `radius`
+    if len(points) == 0 or tree.n == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    neighbours = tree.query_ball_point(points, r=radius)
+    lengths = np.array([len(idx) for idx in neighbours])
+    rows = np.repeat(np.arange(len(points)), lengths)
+    cols = np.concatenate([idx for idx in neighbours if idx] or [[]]).astype(np.int64)
+    return rows, cols
+
+
+def _count_within(tree, xy, points, radii):
+    counts = np.zeros((len(points), len(radii)), dtype=np.int64)
+    if len(xy) == 0 or len(points) == 0:
+        return counts
+    if len(points) > BATCH_THRESHOLD:
+        # Large batches: one C-level counting query per radius beats the
+        # per-point Python loop below
+        for j, radius in enumerate(radii):
+            counts[:, j] = tree.query_ball_point(points, r=radius, return_length=True)
+        return counts
+    neighbours = tree.query_ball_point(points, r=radii.max())
+    for i, idx in enumerate(neighbours):
+        if not idx:
+            continue
+        offsets = xy[idx] - points[i]
+        distances = np.sort(np.hypot(offsets[:, 0], offsets[:, 1]))
+        counts[i] = np.searchsorted(distances, radii, side='right')
+    return counts
+
+
+class TemporalCallIndex:
+    """Calls sorted by date with one KD-tree per calendar month.
+
+    A date window is answered by querying the trees of the months it fully
+    covers and a small temporary tree for each partially covered month, so
+    changing the window never rebuilds the whole index.
+    """
+
+    def __init__(self, xy, times):
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        times = np.asarray(times, dtype='datetime64[ns]')
+        valid = ~np.isnat(times)
+        order = np.argsort(times[valid], kind='stable')
+        self.xy = xy[valid][order]
+        self.times = times[valid][order]
+        if len(self.times):
+            first = pd.Timestamp(self.times[0]).to_period('M').to_timestamp()
+            last = pd.Timestamp(self.times[-1]).to_period('M').to_timestamp() + pd.DateOffset(months=1)
+            edges = pd.date_range(first, last, freq='MS').to_numpy(dtype='datetime64[ns]')
+        else:
+            edges = np.array([], dtype='datetime64[ns]')
+        self.offsets = np.searchsorted(self.times, edges)
+        self.trees = [cKDTree(self.xy[a:b]) for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def __len__(self):
+        return len(self.xy)
+
+    def date_range(self):
+        """(first, last) call dates as datetime.date objects."""
+        return pd.Timestamp(self.times[0]).date(), pd.Timestamp(self.times[-1]).date()
+
+    def _bounds(self, start, end):
+        lo = 0 if start is None else np.searchsorted(self.times, np.datetime64(start, 'ns'))
+        hi = len(self.times) if end is None else np.searchsorted(self.times, np.datetime64(end, 'ns'))
+        return lo, hi
+
+    def window_xy(self, start=None, end=None):
+        """Coordinates of the calls with start <= date < end (a view, no copy)."""
+        lo, hi = self._bounds(start, end)
+        return self.xy[lo:max(lo, hi)]
+
+    def count_within(self, points, radii=NEARBY_RADII, start=None, end=None):
+        """Counts like CallIndex.count_within for calls with start <= date < end."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        radii = np.asarray(radii, dtype=float)
+        counts = np.zeros((len(points), len(radii)), dtype=np.int64)
+        lo, hi = self._bounds(start, end)
+        if len(points) == 0 or lo >= hi:
+            return counts
+        for tree, a, b in zip(self.trees, self.offsets[:-1], self.offsets[1:]):
+            a_window, b_window = max(a, lo), min(b, hi)
+            if a_window >= b_window:
+                continue
+            if (a_window, b_window) != (a, b):
+                tree = cKDTree(self.xy[a_window:b_window])
+            for j, radius in enumerate(radii):
+                counts[:, j] += tree.query_ball_point(points, r=radius, return_length=True)
+        return counts
+
+
+class NearestPointIndex:
+    """KD-tree answering nearest-point distance queries, e.g. for transit stops."""
+
+    def __init__(self, xy, ids=None):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.ids = np.arange(len(self.xy)) if ids is None else np.asarray(ids)
+        self.tree = cKDTree(self.xy)
+
+    def nearest(self, points):
+        """Return (distances, ids) of the nearest feature for each point."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        distances, idx = self.tree.query(points)
+        return distances, self.ids[idx]
+
+
+class NearestLineIndex:
+    """STRtree over line geometries answering nearest-line distance queries."""
+
+    def __init__(self, geometries, ids=None):
+        self.geometries = np.asarray(geometries)
+        self.ids = np.arange(len(self.geometries)) if ids is None else np.asarray(ids)
+        self.tree = STRtree(self.geometries)
+
+    def nearest(self, points):
+        """Return (distances, ids) of the nearest feature for each point."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        (point_idx, geom_idx), distances = self.tree.query_nearest(
+            make_points(points), return_distance=True, all_matches=False
+        )
+        nearest_distances = np.full(len(points), np.inf)
+        nearest_ids = np.empty(len(points), dtype=self.ids.dtype)
+        nearest_distances[point_idx] = distances
+        nearest_ids[point_idx] = self.ids[geom_idx]
+        return nearest_distances, nearest_ids
+
+
+class NearestSegmentIndex:
+    """Nearest-line distances answered from raw vertex arrays, without Shapely.
+
+    Line i has the vertices vertices[offsets[i]:offsets[i + 1]] and the id
+    ids[i], the layout of the shared road arrays. Lines are cut into
+    segments no longer than MAX_SEGMENT_LENGTH and a KD-tree is built over
+    the segment midpoints. A segment is never closer to a point than its
+    midpoint distance minus half its length, so after measuring the segment
+    of the nearest midpoint only the midpoints within that distance plus
+    half the longest segment need checking.
+    """
+
+    MAX_SEGMENT_LENGTH = 200.0
+
+    def __init__(self, vertices, offsets, ids=None):
+        vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        line_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        same_line = line_of[1:] == line_of[:-1]
+        start, end, line = vertices[:-1][same_line], vertices[1:][same_line], line_of[:-1][same_line]
+
+        # Split long segments into equal pieces
+        lengths = np.hypot(*(end - start).T)
+        pieces = np.maximum(1, np.ceil(lengths / self.MAX_SEGMENT_LENGTH)).astype(np.int64)
+        segment = np.repeat(np.arange(len(start)), pieces)
+        first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        step = (np.arange(len(segment)) - first) / pieces[segment]
+        direction = end[segment] - start[segment]
+        self.start = start[segment] + direction * step[:, None]
+        self.end = self.start + direction / pieces[segment][:, None]
+        self.line = line[segment]
+
+        self.ids = np.arange(len(offsets) - 1) if ids is None else np.asarray(ids)
+        self.half_length = (lengths / pieces).max() / 2 if len(lengths) else 0.0
+        self.tree = cKDTree((self.start + self.end) / 2)
+
+    def _distances(self, points, segments):
+        start, end = self.start[segments], self.end[segments]
+        direction = end - start
+        squared = (direction ** 2).sum(axis=1)
+        t = np.divide(((points - start) * direction).sum(axis=1), squared,
+                      out=np.zeros(len(segments)), where=squared > 0)
+        closest = start + direction * np.clip(t, 0.0, 1.0)[:, None]
+        return np.hypot(*(points - closest).T)
+
+    def nearest(self, points):
+        """Return (distances, ids) of the nearest line for each point."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 0 or self.tree.n == 0:
+            return np.full(len(points), np.inf), np.empty(len(points), dtype=self.ids.dtype)
+        _, guess = self.tree.query(points)
+        bound = self._distances(points, guess) + self.half_length
+        candidates = self.tree.query_ball_point(points, r=bound)
+        lengths = np.array([len(idx) for idx in candidates])
+        rows = np.repeat(np.arange(len(points)), lengths)
+        segments = np.concatenate([idx for idx in candidates if idx]).astype(np.int64)
+        distances = self._distances(points[rows], segments)
+        # Closest candidate per point: sort by (point, distance), keep the first
+        order = np.lexsort((distances, rows))
+        first = order[np.r_[0, np.flatnonzero(np.diff(rows[order])) + 1]]
+        return distances[first], self.ids[self.line[segments[first]]]
+
+
+class SiteLocator:
+    """KD-tree over site coordinates for map click hit testing."""
+
+    def __init__(self, xy, ids=None):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.ids = np.arange(len(self.xy)) if ids is None else np.asarray(ids)
+        self.tree = cKDTree(self.xy)
+
+    def nearest_within(self, point, tolerance):
+        """Return the id of the nearest site within `tolerance`, or None."""
+        if len(self.xy) == 0:
+            return None
+        distance, idx = self.tree.query(np.asarray(point, dtype=float).reshape(2), distance_upper_bound=tolerance)
+        if not np.isfinite(distance):
+            return None
+        return self.ids[idx].item()
+
+
+def pixel_tolerance(lng, lat, zoom, pixels=8):
+    """Metric-CRS distance covered by `pixels` screen pixels (default: the site marker radius).
+
+    One pixel spans 360 / (256 * 2**zoom) degrees of longitude; projecting
+    that offset keeps the tolerance correct for whichever metric CRS is used.
+    """
+    degrees = pixels * 360.0 / (256 * 2 ** zoom)
+    xy = data_loader.project_points([lng, lng + degrees], [lat, lat])
+    return float(np.hypot(*(xy[1] - xy[0])))
+
+
+def count_calls_within(points, radii=NEARBY_RADII, index=None):
+    """Return {'Nearby_Count_<r>': counts} for metric x/y points.
+
+    Counts are arrays with one entry per point; the process-wide call index
+    is used unless another index is passed in.
+    """
+    index = index if index is not None else call_index()
+    counts = index.count_within(points, radii)
+    return dict(zip(nearby_count_columns(radii), counts.T))
+
+
+# Indexes are built once per loaded dataset and shared across sessions.
+# The cache holds the source (a Layer or SharedArrays) itself so a reloaded
+# file gets a fresh index.
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _index_for(kind, layer, build):
+    with _lock:
+        entry = _indexes.get(kind)
+        if entry is None or entry[0] is not layer:
+            entry = (layer, build(layer))
+            _indexes[kind] = entry
+        return entry[1]
+
+
+def call_index(path=None):
+    shared = shared_arrays.open_shared() if path is None else None
+    if shared is not None:
+        return _index_for('calls', shared, lambda shared: CallIndex(shared.calls_xy))
+    return _index_for('calls', data_loader.load_calls(path), lambda layer: CallIndex(layer.xy))
+
+
+def temporal_call_index(path=None):
+    """Time-aware call index, or None when the calls have no dates."""
+    shared = shared_arrays.open_shared() if path is None else None
+    if shared is not None:
+        if shared.calls_time is None:
+            return None
+        return _index_for('calls_temporal', shared, lambda shared: TemporalCallIndex(shared.calls_xy, shared.calls_time))
+    layer = data_loader.load_calls(path)
+    if layer.times is None:
+        return None
+    return _index_for('calls_temporal', layer, lambda layer: TemporalCallIndex(layer.xy, layer.times))
+
+
+def transit_index(path=None):
+    shared = shared_arrays.open_shared() if path is None else None
+    if shared is not None:
+        return _index_for('transit', shared, lambda shared: NearestPointIndex(shared.transit_xy, shared.transit_ids))
+    return _index_for('transit', data_loader.load_transit(path or data_loader.TRANSIT_PATH), lambda layer: NearestPointIndex(
+        layer.xy, data_loader.feature_ids(layer.metric, data_loader.TRANSIT_ID_COLUMN)
+    ))
+
+
+def road_index(path=None):
+    shared = shared_arrays.open_shared() if path is None else None
+    if shared is not None:
+        return _index_for('mainroads', shared, lambda shared: NearestSegmentIndex(
+            shared.road_vertices, shared.road_offsets, shared.road_ids
+        ))
+    return _index_for('mainroads', data_loader.load_mainroads(path or data_loader.MAINROADS_PATH), lambda layer: NearestLineIndex(
+        layer.metric.geometry.values, data_loader.feature_ids(layer.metric, data_loader.ROAD_ID_COLUMN)
+    ))
+
+
+def site_locator(path=data_loader.SITES_PATH):
+    return _index_for('sites', data_loader.load_sites(path), lambda layer: SiteLocator(
+        layer.xy, layer.metric.index.to_numpy()
+    ))
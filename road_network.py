@@ -0,0 +1,157 @@
+"""Precompute travel distances to the nearest transit stop over the main road graph.
+
+    python road_network.py road_network.npz --roads MainRoads.geojson --transit Transit.geojson
+
+Road vertices become graph nodes (vertices within SNAP_TOLERANCE of each
+other are merged, joining roads that meet) and consecutive vertices become
+edges weighted by their metric length. One multi-source Dijkstra from every
+transit stop gives each node its distance to the nearest stop, so a query
+is a KD-tree snap onto the graph plus an array lookup.
+"""
+import argparse
+import time
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+import data_loader
+
+ROAD_NETWORK_PATH = 'road_network.npz'
+
+# Vertices closer than this (metric CRS units) are treated as one node
+SNAP_TOLERANCE = 1.0
+
+# Nodes considered when snapping a query point onto the graph; looking past
+# the closest one avoids landing on a small piece not connected to any stop
+SNAP_CANDIDATES = 4
+
+
+class RoadNetwork:
+    """Road graph nodes with their network distance to the nearest transit stop."""
+
+    def __init__(self, nodes, transit_distance, crs=data_loader.METRIC_CRS):
+        self.nodes = np.asarray(nodes, dtype=float)
+        self.transit_distance = np.asarray(transit_distance, dtype=float)
+        self.crs = crs
+        self.tree = cKDTree(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def transit_distance_at(self, points):
+        """Distance from metric x/y points to the nearest transit stop along the roads.
+
+        The straight-line walk onto the road graph is included. Points whose
+        nearby nodes cannot reach any stop get inf.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 0:
+            return np.array([], dtype=float)
+        k = min(SNAP_CANDIDATES, len(self.nodes))
+        snap, idx = self.tree.query(points, k=k)
+        snap, idx = snap.reshape(len(points), k), idx.reshape(len(points), k)
+        # Closest candidate that reaches a stop; taking the smallest total
+        # instead would let a point jump across a river to the far road
+        along_roads = self.transit_distance[idx]
+        first = np.isfinite(along_roads).argmax(axis=1)
+        rows = np.arange(len(points))
+        return snap[rows, first] + along_roads[rows, first]
+
+    def save(self, path=ROAD_NETWORK_PATH):
+        np.savez_compressed(path, nodes=self.nodes, transit_distance=self.transit_distance, crs=self.crs)
+
+    @classmethod
+    def load(cls, path=ROAD_NETWORK_PATH):
+        with np.load(path) as data:
+            return cls(data['nodes'], data['transit_distance'], str(data['crs']))
+
+
+def _edge_matrix(start, end, weights, size):
+    # Sparse matrix of start -> end edges, keeping the lightest of parallel edges
+    order = np.lexsort((weights, end, start))
+    start, end, weights = start[order], end[order], weights[order]
+    first = np.ones(len(start), dtype=bool)
+    first[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+    return coo_matrix((weights[first], (start[first], end[first])), shape=(size, size)).tocsr()
+
+
+def road_graph(lines, tolerance=SNAP_TOLERANCE):
+    """Return (nodes, graph) for metric-CRS road lines.
+
+    `nodes` is an (N, 2) array and `graph` a symmetric sparse matrix of edge
+    lengths between node positions.
+    """
+    parts = shapely.get_parts(np.asarray(lines))
+    vertices, vertex_part = shapely.get_coordinates(parts, return_index=True)
+    # Merge vertices on a tolerance grid so roads sharing an end point connect
+    _, first, node_of = np.unique(
+        np.round(vertices / tolerance).astype(np.int64), axis=0, return_index=True, return_inverse=True,
+    )
+    node_of = node_of.ravel()
+    nodes = vertices[first]
+
+    same_part = vertex_part[1:] == vertex_part[:-1]
+    start, end = node_of[:-1][same_part], node_of[1:][same_part]
+    keep = start != end
+    start, end = start[keep], end[keep]
+    lengths = np.hypot(*(nodes[end] - nodes[start]).T)
+    graph = _edge_matrix(np.concatenate([start, end]), np.concatenate([end, start]),
+                         np.concatenate([lengths, lengths]), len(nodes))
+    return nodes, graph
+
+
+def transit_distances(nodes, graph, stops_xy):
+    """Network distance from every node to its nearest transit stop.
+
+    Each stop is joined to its closest node, and all stops are reached from
+    one virtual source node, so a single Dijkstra run covers every stop.
+    """
+    snap, stop_node = cKDTree(nodes).query(np.asarray(stops_xy, dtype=float).reshape(-1, 2))
+    size = len(nodes) + 1
+    source = len(nodes)
+    graph = graph.tocoo()
+    edges = _edge_matrix(
+        np.concatenate([graph.row, np.full(len(stop_node), source)]),
+        np.concatenate([graph.col, stop_node]),
+        np.concatenate([graph.data, snap]),
+        size,
+    )
+    return dijkstra(edges, directed=True, indices=source)[:source]
+
+
+def build_network(roads_path=data_loader.MAINROADS_PATH, transit_path=data_loader.TRANSIT_PATH):
+    roads = data_loader.load_mainroads(roads_path)
+    transit = data_loader.load_transit(transit_path)
+    nodes, graph = road_graph(roads.metric.geometry.values)
+    return RoadNetwork(nodes, transit_distances(nodes, graph, transit.xy))
+
+
+def load_network(path=ROAD_NETWORK_PATH):
+    """Return the cached network, or None when it is missing or built for another metric CRS."""
+    try:
+        network = data_loader.cached('road_network', path, RoadNetwork.load)
+    except FileNotFoundError:
+        return None
+    return network if network.crs == data_loader.METRIC_CRS else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', default=ROAD_NETWORK_PATH)
+    parser.add_argument('--roads', default=data_loader.MAINROADS_PATH)
+    parser.add_argument('--transit', default=data_loader.TRANSIT_PATH)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    network = build_network(args.roads, args.transit)
+    network.save(args.output)
+    reachable = np.isfinite(network.transit_distance).mean()
+    print(f'Wrote {len(network)} nodes ({reachable:.0%} reach a stop) to {args.output} '
+          f'in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Score candidate locations with the site features and K-means clusters.
+
+    python scoring.py parcels.geojson scored.geojson --workers 8
+"""
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import data_loader
+import proximity
+import road_network
+import site_features
+from caching import LRUCache
+
+# K-means labels are remapped onto the three site clusters shown in the app
+# Original: sites['Cluster'] = sites['Cluster'].replace({0: 1, 1: 2, 2: 1, 3: 3})
+CLUSTER_REMAP = {0: 1, 1: 2, 2: 1, 3: 3}
+
+
+# Custom point results shared by every session, keyed on the click rounded
+# to CLICK_PRECISION decimal degrees (4 places is roughly 10m)
+CLICK_PRECISION = 4
+point_cache = LRUCache(maxsize=4096)
+
+# Site frames rescored for a call date window, keyed on the window
+window_cache = LRUCache(maxsize=32)
+
+
+def _remap_lookup(remap, n_labels):
+    # Lookup table so the remap is a single fancy-indexing operation; `remap`
+    # is a {label: cluster} dict or an array indexed by label
+    if not isinstance(remap, dict):
+        return np.asarray(remap, dtype=np.int64)
+    lookup = np.arange(max([n_labels - 1, *remap.keys()]) + 1)
+    for label, cluster in remap.items():
+        lookup[label] = cluster
+    return lookup
+
+
+class ClusterModel:
+    """Scaler + K-means pair that classifies feature rows in one batch.
+
+    Uses the scikit-learn objects themselves; the app predicts with
+    CentroidModel, and this class is kept as its reference.
+    """
+
+    def __init__(self, scaler, kmeans, remap=CLUSTER_REMAP):
+        self.scaler = scaler
+        self.kmeans = kmeans
+        self.remap = dict(remap)
+        self._lookup = _remap_lookup(self.remap, kmeans.n_clusters)
+
+    def predict(self, features):
+        """Return remapped cluster labels for a DataFrame or (N, 6) array of features."""
+        if not isinstance(features, pd.DataFrame):
+            features = pd.DataFrame(np.asarray(features, dtype=float).reshape(-1, len(site_features.FEATURE_COLUMNS)),
+                                    columns=site_features.FEATURE_COLUMNS)
+        labels = self.kmeans.predict(self.scaler.transform(features[site_features.FEATURE_COLUMNS]))
+        return self._lookup[labels]
+
+
+class CentroidModel:
+    """Nearest-centroid predictor holding the scaler and K-means as NumPy arrays.
+
+    Gives the same clusters as StandardScaler.transform, KMeans.predict and
+    the label remap, with one matrix product per batch and no scikit-learn.
+    """
+
+    def __init__(self, mean, scale, centroids, remap=CLUSTER_REMAP):
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self._lookup = _remap_lookup(remap, len(self.centroids))
+        self._centroid_norms = (self.centroids ** 2).sum(axis=1)
+
+    @property
+    def fingerprint(self):
+        """Short hash of the model arrays, recorded by outputs built with it."""
+        digest = hashlib.sha1()
+        for array in (self.mean, self.scale, self.centroids, self._lookup):
+            digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def from_sklearn(cls, scaler, kmeans, remap=CLUSTER_REMAP):
+        return cls(scaler.mean_, scaler.scale_, kmeans.cluster_centers_, remap)
+
+    @classmethod
+    def from_artifact(cls, arrays):
+        """Build the model from the arrays of a train_model.py artifact."""
+        if list(arrays['feature_columns']) != site_features.FEATURE_COLUMNS:
+            raise ValueError(f'model features {list(arrays["feature_columns"])} do not match FEATURE_COLUMNS')
+        if str(arrays['metric_crs']) != data_loader.METRIC_CRS:
+            raise ValueError(f'model was trained on {arrays["metric_crs"]} distances but the metric CRS is '
+                             f'{data_loader.METRIC_CRS}, retrain it with train_model.py')
+        return cls(arrays['mean'], arrays['scale'], arrays['centroids'], arrays['remap'])
+
+    def predict(self, features):
+        """Return remapped cluster labels for a DataFrame or (N, 6) array of features."""
+        if isinstance(features, pd.DataFrame):
+            features = features[site_features.FEATURE_COLUMNS].to_numpy(dtype=float)
+        features = np.asarray(features, dtype=float).reshape(-1, len(site_features.FEATURE_COLUMNS))
+        scaled = (features - self.mean) / self.scale
+        # |z - c|^2 = |z|^2 - 2 z.c + |c|^2, and |z|^2 is the same for every centroid
+        distances = self._centroid_norms - 2 * scaled @ self.centroids.T
+        return self._lookup[distances.argmin(axis=1)]
+
+
+def load_model(path=None):
+    """Return the process-wide CentroidModel.
+
+    It is read from the cluster_model.npz artifact when there is one, and
+    otherwise from the arrays of the K-means pickle (which imports
+    scikit-learn to unpickle).
+    """
+    if path is None:
+        path = data_loader.MODEL_PATH if os.path.exists(data_loader.MODEL_PATH) else data_loader.KMEANS_PATH
+    if path.endswith('.npz'):
+        return data_loader.cached('centroid_model', path, lambda path: CentroidModel.from_artifact(
+            data_loader.load_cluster_model(path)
+        ))
+    return data_loader.cached('centroid_model', path, lambda path: CentroidModel.from_sklearn(
+        *data_loader.load_kmeans(path)
+    ))
+
+
+def score_points(xy, model=None, **indexes):
+    """Return the six features plus a Cluster column for metric x/y points.
+
+    Extra keyword arguments (calls, transit, roads, window, temporal,
+    network) are passed through to site_features.compute_features.
+    """
+    model = model if model is not None else load_model()
+    features = site_features.compute_features(xy, **indexes)
+    features['Cluster'] = model.predict(features) if len(features) else np.array([], dtype=np.int64)
+    return features
+
+
+def score_points_parallel(xy, model=None, workers=None, chunk_size=site_features.CHUNK_SIZE, **paths):
+    """score_points() for large point sets, with features computed across a process pool.
+
+    Extra keyword arguments (calls_path, roads_path, transit_path, window,
+    network_path, with_density) select the datasets, see site_features.compute_features_parallel.
+    Clusters are predicted here in one vectorized call.
+    """
+    model = model if model is not None else load_model()
+    features = site_features.compute_features_parallel(xy, workers, chunk_size, **paths)
+    features['Cluster'] = model.predict(features) if len(features) else np.array([], dtype=np.int64)
+    return features
+
+
+def score_lonlat(lng, lat, model=None, **indexes):
+    """Score longitude/latitude arrays (or scalars)."""
+    return score_points(data_loader.project_points(lng, lat), model, **indexes)
+
+
+def score_frame(gdf, model=None, **indexes):
+    """Return a copy of a point GeoDataFrame with feature and Cluster columns."""
+    scores = score_points(site_features.point_xy(gdf), model, **indexes)
+    gdf = gdf.copy()
+    for column in scores.columns:
+        gdf[column] = scores[column].to_numpy()
+    return gdf
+
+
+def score_click(lng, lat, precision=CLICK_PRECISION, window=None, network=None):
+    """Return a dict of features and Cluster for a clicked location.
+
+    The location is rounded to `precision` decimal places and scored there,
+    so repeated and nearby clicks from any session share one cached result.
+    `window` restricts the call counts to a (start, end) date range and a
+    road_network.RoadNetwork measures the transit distance along the roads.
+    """
+    lng, lat = round(float(lng), precision), round(float(lat), precision)
+    model = load_model()
+    indexes = {
+        'transit': proximity.transit_index(),
+        'roads': proximity.road_index(),
+    }
+    if window is not None:
+        indexes['temporal'] = proximity.temporal_call_index()
+    else:
+        indexes['calls'] = proximity.call_index()
+    if network is not None:
+        indexes['network'] = network
+    # Index and model identities are part of the key so reloaded data is rescored
+    key = (lng, lat, window, id(model)) + tuple(id(index) for index in indexes.values())
+
+    def build():
+        scores = score_lonlat(lng, lat, model, window=window, **indexes).iloc[0]
+        result = {column: float(scores[column]) for column in site_features.FEATURE_COLUMNS}
+        result['Cluster'] = int(scores['Cluster'])
+        return result
+
+    return dict(point_cache.get(key, build, sources=(model,) + tuple(indexes.values())))
+
+
+def sites_for_window(sites, window):
+    """Return `sites` with Nearby_Count_* and Cluster recomputed for a date window.
+
+    Distance columns are kept. Results are cached per window, so toggling
+    back to an earlier window reuses the same frame.
+    """
+    if window is None:
+        return sites
+    temporal = proximity.temporal_call_index()
+
+    def build():
+        counts = temporal.count_within(site_features.point_xy(sites), start=window[0], end=window[1])
+        view = sites.copy()
+        view[proximity.nearby_count_columns()] = counts
+        view['Cluster'] = model.predict(view)
+        return view
+
+    model = load_model()
+    return window_cache.get((id(sites), id(temporal), id(model), window), build, sources=(sites, temporal, model))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('points', help='Input point file (any format geopandas can read)')
+    parser.add_argument('output', help='Output GeoJSON file')
+    parser.add_argument('--calls', help='Calls CSV or Parquet file (default: converted Parquet if present)')
+    parser.add_argument('--roads', help='Main roads file (default: shared arrays or MainRoads.geojson)')
+    parser.add_argument('--transit', help='Transit stops file (default: shared arrays or Transit.geojson)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=site_features.CHUNK_SIZE)
+    parser.add_argument('--network', metavar='PATH',
+                        help='Road network from road_network.py; transit distance is then measured along the roads')
+    parser.add_argument('--density', action='store_true', help='Add the kernel density of calls as Call_Density')
+    args = parser.parse_args(argv)
+    if args.network and road_network.load_network(args.network) is None:
+        parser.error(f'{args.network} is missing or was built for another metric CRS')
+
+    start = time.perf_counter()
+    points = gpd.read_file(args.points).to_crs(data_loader.DISPLAY_CRS)
+    scores = score_points_parallel(
+        site_features.point_xy(points), workers=args.workers, chunk_size=args.chunk_size,
+        calls_path=args.calls, roads_path=args.roads, transit_path=args.transit, network_path=args.network,
+        with_density=args.density,
+    )
+    for column in scores.columns:
+        points[column] = scores[column].to_numpy()
+    points.to_file(args.output, driver='GeoJSON')
+    print(f'Scored {len(points)} points into {args.output} in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
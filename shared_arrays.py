@@ -0,0 +1,148 @@
+"""Export the hot coordinate arrays as .npy files shared by every app worker.
+
+    python shared_arrays.py [directory]
+
+Workers open the files read-only with np.load(mmap_mode='r'), so the
+coordinates live once in the OS page cache instead of once per process as
+GeoDataFrames of Shapely objects. Nearest-road queries run straight on the
+road vertex and offset arrays (proximity.NearestSegmentIndex); each worker
+only keeps a KD-tree over the segment midpoints.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import shapely
+
+import data_loader
+
+SHARED_ARRAYS_DIR = 'shared_arrays'
+MANIFEST_NAME = 'manifest.json'
+
+ARRAY_NAMES = [
+    'calls_xy', 'calls_lonlat',
+    'transit_xy', 'transit_ids',
+    'road_vertices', 'road_offsets', 'road_ids',
+]
+
+# Arrays only exported when the source data has them
+OPTIONAL_ARRAY_NAMES = ['calls_time']
+
+
+class SharedArrays:
+    """Read-only memory-mapped coordinate arrays.
+
+    Roads are stored as one vertex array plus offsets: line i has the
+    vertices road_vertices[road_offsets[i]:road_offsets[i + 1]] and belongs to
+    the road road_ids[i] (multi-part roads contribute one line per part).
+    """
+
+    def __init__(self, arrays, manifest):
+        self.manifest = manifest
+        for name in ARRAY_NAMES + OPTIONAL_ARRAY_NAMES:
+            setattr(self, name, arrays.get(name))
+
+
+def _ids(values):
+    # Object arrays cannot be memory-mapped, store them as fixed-width strings
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype == object else values
+
+
+def export(directory=SHARED_ARRAYS_DIR, calls_path=None,
+           transit_path=data_loader.TRANSIT_PATH, roads_path=data_loader.MAINROADS_PATH):
+    """Write the shared arrays for the given datasets into `directory`."""
+    calls_path = calls_path or data_loader.default_calls_path()
+    calls = data_loader.load_calls(calls_path)
+    transit = data_loader.load_transit(transit_path)
+    roads = data_loader.load_mainroads(roads_path)
+
+    parts, part_index = shapely.get_parts(roads.metric.geometry.values, return_index=True)
+    vertices, vertex_part = shapely.get_coordinates(parts, return_index=True)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(vertex_part, minlength=len(parts)))])
+
+    arrays = {
+        'calls_xy': calls.xy,
+        'calls_lonlat': calls.lonlat,
+        'transit_xy': transit.xy,
+        'transit_ids': _ids(data_loader.feature_ids(transit.metric, data_loader.TRANSIT_ID_COLUMN)),
+        'road_vertices': vertices,
+        'road_offsets': offsets.astype(np.int64),
+        'road_ids': _ids(data_loader.feature_ids(roads.metric, data_loader.ROAD_ID_COLUMN)[part_index]),
+    }
+
+    times = calls.times
+    if times is not None:
+        arrays['calls_time'] = times
+
+    os.makedirs(directory, exist_ok=True)
+    for name in OPTIONAL_ARRAY_NAMES:
+        if name not in arrays and os.path.exists(os.path.join(directory, f'{name}.npy')):
+            os.remove(os.path.join(directory, f'{name}.npy'))
+    for name, array in arrays.items():
+        # Write then rename, so workers that have the old file mapped keep
+        # reading it instead of seeing it truncated
+        path = os.path.join(directory, f'{name}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(path + '.tmp', path)
+
+    manifest = {
+        'metric_crs': data_loader.METRIC_CRS,
+        'sources': {
+            os.path.abspath(path): os.stat(path).st_mtime_ns
+            for path in (calls_path, transit_path, roads_path)
+        },
+    }
+    # The manifest is written last so readers never see a partial export
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _open(manifest_path):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(manifest_path)
+    arrays = {
+        name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        for name in ARRAY_NAMES + OPTIONAL_ARRAY_NAMES
+        if name in ARRAY_NAMES or os.path.exists(os.path.join(directory, f'{name}.npy'))
+    }
+    return SharedArrays(arrays, manifest)
+
+
+def is_current(shared):
+    """True when the arrays match the metric CRS and no source file has changed."""
+    if shared.manifest.get('metric_crs') != data_loader.METRIC_CRS:
+        return False
+    for path, mtime in shared.manifest.get('sources', {}).items():
+        # Replicas may ship only the exported arrays, without the sources
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != mtime:
+            return False
+    return True
+
+
+def open_shared(directory=SHARED_ARRAYS_DIR):
+    """Return the process-wide SharedArrays, or None if missing or stale."""
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    shared = data_loader.cached('shared_arrays', manifest_path, _open)
+    return shared if is_current(shared) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory', nargs='?', default=SHARED_ARRAYS_DIR)
+    parser.add_argument('--calls', help='Calls CSV or Parquet file (default: converted Parquet if present)')
+    parser.add_argument('--roads', default=data_loader.MAINROADS_PATH)
+    parser.add_argument('--transit', default=data_loader.TRANSIT_PATH)
+    args = parser.parse_args(argv)
+    export(args.directory, args.calls, args.transit, args.roads)
+    print(f'Wrote shared arrays to {args.directory}')
+
+
+if __name__ == '__main__':
+    main()
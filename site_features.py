@@ -0,0 +1,187 @@
+"""Rebuild the proximity features of Sites_with_Clusters from the raw inputs.
+
+    python site_features.py Sites_with_Clusters.geojson out.geojson \
+        --calls Overdose_zip_geocodio.csv --roads MainRoads.geojson --transit Transit.geojson
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import data_loader
+import density
+import proximity
+import road_network
+
+# Feature columns in the order the K-means model expects them
+DISTANCE_COLUMNS = ['Nearest_Transit_Distance', 'Nearest_Road_Distance']
+FEATURE_COLUMNS = proximity.nearby_count_columns() + DISTANCE_COLUMNS
+
+# Number of points handed to a worker at a time
+CHUNK_SIZE = 20000
+
+
+def compute_features(xy, calls=None, transit=None, roads=None, window=None, temporal=None, network=None,
+                     density_surface=None):
+    """Return a DataFrame of the six features for metric x/y points.
+
+    `calls`, `transit` and `roads` are proximity indexes; the process-wide
+    indexes for the default dataset paths are used when they are omitted.
+    With a (start, end) date `window` the counts only include calls dated
+    start <= date < end, taken from the `temporal` index. With a
+    road_network.RoadNetwork the transit distance is measured along the roads.
+    A density.DensitySurface adds a Call_Density column, which the K-means
+    model does not use.
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    transit = transit if transit is not None else proximity.transit_index()
+    roads = roads if roads is not None else proximity.road_index()
+
+    if window is not None:
+        temporal = temporal if temporal is not None else proximity.temporal_call_index()
+        counts = temporal.count_within(xy, start=window[0], end=window[1])
+    else:
+        calls = calls if calls is not None else proximity.call_index()
+        counts = calls.count_within(xy)
+    features = pd.DataFrame(counts, columns=proximity.nearby_count_columns())
+    features['Nearest_Transit_Distance'], _ = transit.nearest(xy)
+    if network is not None:
+        # Straight-line distance is kept where the roads reach no stop
+        along_roads = network.transit_distance_at(xy)
+        features['Nearest_Transit_Distance'] = np.where(
+            np.isfinite(along_roads), along_roads, features['Nearest_Transit_Distance'],
+        )
+    features['Nearest_Road_Distance'], _ = roads.nearest(xy)
+    if density_surface is not None:
+        features[density.DENSITY_COLUMN] = density_surface.sample(xy)
+    return features
+
+
+def _indexes(calls_path=None, roads_path=None, transit_path=None, window=None, network_path=None,
+             with_density=False):
+    # Index keyword arguments for compute_features, from the process-wide caches
+    indexes = {
+        'transit': proximity.transit_index(transit_path),
+        'roads': proximity.road_index(roads_path),
+    }
+    if network_path is not None:
+        indexes['network'] = road_network.load_network(network_path)
+    if with_density:
+        indexes['density_surface'] = density.call_density_surface(
+            data_loader.load_calls(calls_path).xy if calls_path is not None else None
+        )
+    if window is not None:
+        indexes['temporal'] = proximity.temporal_call_index(calls_path)
+    else:
+        indexes['calls'] = proximity.call_index(calls_path)
+    return indexes
+
+
+# Indexes of a pool worker, set once by _init_worker
+_worker_indexes = {}
+
+
+def _init_worker(calls_path, roads_path, transit_path, window, network_path, with_density):
+    # Forked workers inherit the parent's indexes and find them in the caches;
+    # spawned workers build them, from the memory-mapped shared arrays when
+    # the default datasets are used
+    _worker_indexes.update(_indexes(calls_path, roads_path, transit_path, window, network_path, with_density))
+    _worker_indexes['window'] = window
+
+
+def _features_chunk(xy):
+    return compute_features(xy, **_worker_indexes).to_numpy()
+
+
+def compute_features_parallel(xy, workers=None, chunk_size=CHUNK_SIZE, calls_path=None,
+                              roads_path=None, transit_path=None, window=None, network_path=None,
+                              with_density=False):
+    """compute_features() over chunks of `xy` spread across a process pool.
+
+    Each worker holds read-only indexes for the given dataset paths (the
+    defaults use the shared arrays when exported). Rows come back in the
+    order of `xy` whatever the number of workers. `workers` defaults to the
+    number of CPUs; with one worker, or a single chunk, the chunks run in
+    this process.
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    workers = workers or os.cpu_count() or 1
+    chunks = [xy[start:start + chunk_size] for start in range(0, len(xy), chunk_size)]
+    if workers == 1 or len(chunks) <= 1:
+        indexes = _indexes(calls_path, roads_path, transit_path, window, network_path, with_density)
+        results = [compute_features(chunk, window=window, **indexes).to_numpy() for chunk in chunks]
+    else:
+        if multiprocessing.get_start_method() == 'fork':
+            # Build the indexes before forking so every worker shares them
+            _indexes(calls_path, roads_path, transit_path, window, network_path, with_density)
+        with ProcessPoolExecutor(min(workers, len(chunks)), initializer=_init_worker,
+                                 initargs=(calls_path, roads_path, transit_path, window, network_path,
+                                           with_density)) as pool:
+            results = list(pool.map(_features_chunk, chunks))
+    columns = FEATURE_COLUMNS + ([density.DENSITY_COLUMN] if with_density else [])
+    if not results:
+        return pd.DataFrame(np.empty((0, len(columns))), columns=columns)
+    return pd.DataFrame(np.concatenate(results), columns=columns)
+
+
+def point_xy(gdf):
+    """Metric x/y coordinates of a point GeoDataFrame."""
+    metric = gdf.to_crs(data_loader.METRIC_CRS)
+    return np.column_stack([metric.geometry.x.to_numpy(), metric.geometry.y.to_numpy()])
+
+
+def build_site_features(sites, calls_path=None,
+                        roads_path=data_loader.MAINROADS_PATH,
+                        transit_path=data_loader.TRANSIT_PATH,
+                        workers=1, network_path=None, with_density=False):
+    """Return a copy of `sites` with every feature column recomputed.
+
+    With a `network_path` the transit distance is measured along the roads,
+    and `with_density` adds the Call_Density column.
+    """
+    features = compute_features_parallel(
+        point_xy(sites), workers,
+        calls_path=calls_path, roads_path=roads_path, transit_path=transit_path, network_path=network_path,
+        with_density=with_density,
+    )
+    sites = sites.copy()
+    for column in features.columns:
+        sites[column] = features[column].to_numpy()
+    return sites
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sites', help='Input sites file (any format geopandas can read)')
+    parser.add_argument('output', help='Output GeoJSON file')
+    parser.add_argument('--calls', help='Calls CSV or Parquet file (default: converted Parquet if present)')
+    parser.add_argument('--roads', default=data_loader.MAINROADS_PATH)
+    parser.add_argument('--transit', default=data_loader.TRANSIT_PATH)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--network', metavar='PATH',
+                        help='Road network from road_network.py; transit distance is then measured along the roads')
+    parser.add_argument('--density', action='store_true', help='Add the kernel density of calls as Call_Density')
+    args = parser.parse_args(argv)
+
+    # Shapefiles truncate column names to 10 characters (Nearby_Cou, Nearby_C_1, ...)
+    if args.output.lower().endswith('.shp'):
+        parser.error('shapefile output truncates the feature column names, write GeoJSON instead')
+    if args.network and road_network.load_network(args.network) is None:
+        parser.error(f'{args.network} is missing or was built for another metric CRS')
+
+    start = time.perf_counter()
+    sites = gpd.read_file(args.sites).to_crs(data_loader.DISPLAY_CRS)
+    sites = build_site_features(sites, args.calls, args.roads, args.transit, args.workers, args.network,
+                                args.density)
+    sites.to_file(args.output, driver='GeoJSON')
+    print(f'Wrote {len(sites)} sites to {args.output} in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
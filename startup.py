@@ -0,0 +1,141 @@
+"""Import the app's modules and load its datasets in a background thread.
+
+    python startup.py
+
+The first session of a process starts the loader and every session waits
+on the same thread, so app.py can draw the page skeleton before anything
+heavy is imported. Each phase is timed and the report is printed when the
+loader finishes; run this file to see it for a cold start.
+"""
+import importlib
+import threading
+import time
+
+# Modules imported by the loader, heaviest dependencies first
+MODULES = [
+    'numpy', 'pandas', 'geopandas', 'scipy.spatial', 'folium', 'streamlit_folium',
+    'data_loader', 'shared_arrays', 'proximity', 'scoring', 'cluster_grid', 'road_network',
+    'map_layers', 'density', 'placement',
+]
+
+
+def _import_modules():
+    for name in MODULES:
+        importlib.import_module(name)
+
+
+def _load_calls():
+    # Drawn from the memory-mapped shared arrays when they have been exported
+    import data_loader
+    import shared_arrays
+    if shared_arrays.open_shared() is None:
+        data_loader.load_calls()
+
+
+def _phase(module, function):
+    # Calls module.function() once the import phase has run
+    return lambda: getattr(importlib.import_module(module), function)()
+
+
+# (name, loader) in the order they run. The datasets land in the process-wide
+# caches of data_loader and proximity, where the app finds them.
+PHASES = [
+    ('Import modules', _import_modules),
+    ('Sites', _phase('data_loader', 'load_sites')),
+    ('Calls', _load_calls),
+    ('Call date index', _phase('proximity', 'temporal_call_index')),
+    ('Cluster model', _phase('scoring', 'load_model')),
+    ('Cluster grid', _phase('cluster_grid', 'load_grid')),
+    ('Road network', _phase('road_network', 'load_network')),
+    ('Site locator', _phase('proximity', 'site_locator')),
+    ('Call index', _phase('proximity', 'call_index')),
+    ('Transit index', _phase('proximity', 'transit_index')),
+    ('Road index', _phase('proximity', 'road_index')),
+]
+
+# The app draws once this phase has run; the indexes only used to answer
+# clicks keep loading behind it
+READY_PHASE = 'Road network'
+
+
+class Startup:
+    """One run of the PHASES, with the seconds each took."""
+
+    def __init__(self, phases=PHASES):
+        self.phases = phases
+        self.timings = []
+        self.current = None
+        self.error = None
+        self.finished = False
+        self._changed = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='startup', daemon=True)
+
+    def _run(self):
+        try:
+            for name, load in self.phases:
+                self.current = name
+                start = time.perf_counter()
+                load()
+                with self._changed:
+                    self.timings.append((name, time.perf_counter() - start))
+                    self._changed.notify_all()
+            print('Startup timings:\n  ' + '\n  '.join(self.report()), flush=True)
+        except Exception as error:
+            self.error = error
+        finally:
+            with self._changed:
+                self.current = None
+                self.finished = True
+                self._changed.notify_all()
+
+    def wait(self, phase=None, timeout=None):
+        """Block until `phase` (by default the last one) has run.
+
+        Returns False if `timeout` seconds pass first, and re-raises the
+        error of a failed phase.
+        """
+        def reached():
+            return self.finished or (phase is not None and phase in dict(self.timings))
+        with self._changed:
+            self._changed.wait_for(reached, timeout)
+        if self.error is not None:
+            raise self.error
+        return reached()
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.timings)
+
+    def report(self):
+        """Lines with the seconds of each phase that has run, then the total."""
+        width = max(len(name) for name, _ in self.phases)
+        lines = [f'{name:<{width}}  {seconds:6.2f}s' for name, seconds in self.timings]
+        lines.append(f'{"Total":<{width}}  {self.total:6.2f}s')
+        return lines
+
+
+_startup = None
+_lock = threading.Lock()
+
+
+def start():
+    """Return the process-wide Startup, starting it on the first call.
+
+    A run that failed is started again, so a missing file that has since
+    been restored does not need a server restart.
+    """
+    global _startup
+    with _lock:
+        if _startup is None or _startup.error is not None:
+            _startup = Startup()
+            _startup.thread.start()
+        return _startup
+
+
+def main():
+    # The report is printed by the loader thread when it finishes
+    start().wait()
+
+
+if __name__ == '__main__':
+    main()
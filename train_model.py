@@ -0,0 +1,160 @@
+"""Fit the feature scaler and K-means model and write them as a plain .npz artifact.
+
+    python train_model.py cluster_model.npz --sites Sites_with_Clusters.geojson [--stored-features]
+    python train_model.py cluster_model.npz --from-pickle kmeans_algo.pkl
+    python train_model.py cluster_model.npz --check-parity
+
+The artifact holds arrays only: the scaler means and scales, the centroids
+in scaled units and the label -> cluster remap, plus metadata. Loading it
+needs neither pickle nor scikit-learn.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import sklearn
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+import data_loader
+import proximity
+import scoring
+import site_features
+
+# Bumped when the arrays stored in the artifact change
+ARTIFACT_VERSION = 1
+
+# Settings the shipped kmeans_algo.pkl was fitted with
+N_CLUSTERS = 4
+RANDOM_STATE = 42
+
+# Training sets larger than this use MiniBatchKMeans with the 'auto' algorithm
+MINIBATCH_THRESHOLD = 100000
+
+
+def derive_remap(centroids, columns=site_features.FEATURE_COLUMNS):
+    """Label -> cluster array ranking the centroids (in scaled units) by call counts.
+
+    The label with the highest mean Nearby_Count_* z-score becomes cluster 3,
+    the next cluster 2 and every other label cluster 1. For the shipped
+    model this gives scoring.CLUSTER_REMAP, {0: 1, 1: 2, 2: 1, 3: 3}.
+    """
+    centroids = np.asarray(centroids, dtype=float)
+    counts = [list(columns).index(column) for column in proximity.nearby_count_columns()]
+    order = np.argsort(-centroids[:, counts].mean(axis=1), kind='stable')
+    remap = np.ones(len(centroids), dtype=np.int64)
+    remap[order[:2]] = [3, 2][:len(order)]
+    return remap
+
+
+def fit(features, n_clusters=N_CLUSTERS, algorithm='auto', random_state=RANDOM_STATE):
+    """Return the fitted (scaler, kmeans) for a DataFrame of FEATURE_COLUMNS."""
+    features = features[site_features.FEATURE_COLUMNS]
+    scaler = StandardScaler().fit(features)
+    scaled = scaler.transform(features)
+    if algorithm == 'auto':
+        algorithm = 'minibatch' if len(features) > MINIBATCH_THRESHOLD else 'kmeans'
+    if algorithm == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters, random_state=random_state, n_init='auto', batch_size=4096)
+    else:
+        kmeans = KMeans(n_clusters, random_state=random_state, n_init='auto')
+    return scaler, kmeans.fit(scaled)
+
+
+def artifact(scaler, kmeans, **metadata):
+    """Arrays and metadata of a fitted model, as stored in the .npz artifact."""
+    arrays = {
+        'version': np.int64(ARTIFACT_VERSION),
+        'feature_columns': np.array(site_features.FEATURE_COLUMNS),
+        'mean': scaler.mean_.astype(float),
+        'scale': scaler.scale_.astype(float),
+        'centroids': kmeans.cluster_centers_.astype(float),
+        'remap': derive_remap(kmeans.cluster_centers_),
+        'metric_crs': np.str_(data_loader.METRIC_CRS),
+        'algorithm': np.str_(type(kmeans).__name__),
+        'inertia': np.float64(kmeans.inertia_),
+        'sklearn_version': np.str_(sklearn.__version__),
+        'trained_at': np.str_(pd.Timestamp.now(tz='UTC').isoformat()),
+    }
+    arrays.update({name: np.asarray(value) for name, value in metadata.items()})
+    return arrays
+
+
+def save_artifact(arrays, path=data_loader.MODEL_PATH):
+    # Write then rename, so running apps never read a partial file
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def check_parity(model_path=data_loader.MODEL_PATH, pickle_path=data_loader.KMEANS_PATH,
+                 sites_path=data_loader.SITES_PATH, samples=100000, seed=0):
+    """Compare the NumPy predictor of an artifact with the pickled scikit-learn model.
+
+    Both classify the stored site features plus `samples` random feature
+    rows spread over the scaler's range. Returns (rows compared, rows that
+    disagree).
+    """
+    scaler, kmeans = data_loader.load_kmeans(pickle_path)
+    reference = scoring.ClusterModel(scaler, kmeans)
+    model = scoring.CentroidModel.from_artifact(data_loader.load_cluster_model(model_path))
+
+    rng = np.random.default_rng(seed)
+    random_rows = np.abs(scaler.mean_ + 2 * scaler.scale_ * rng.standard_normal((samples, len(scaler.mean_))))
+    random_rows[:, :len(proximity.NEARBY_RADII)] = np.round(random_rows[:, :len(proximity.NEARBY_RADII)])
+    sites = gpd.read_file(sites_path)
+    features = np.vstack([sites[site_features.FEATURE_COLUMNS].to_numpy(dtype=float), random_rows])
+    return len(features), int(np.count_nonzero(model.predict(features) != reference.predict(features)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', default=data_loader.MODEL_PATH)
+    parser.add_argument('--sites', default=data_loader.SITES_PATH, help='Training sites (any format geopandas can read)')
+    parser.add_argument('--stored-features', action='store_true',
+                        help='Train on the feature columns already in the sites file instead of rebuilding them')
+    parser.add_argument('--calls', help='Calls CSV or Parquet file (default: converted Parquet if present)')
+    parser.add_argument('--roads', default=data_loader.MAINROADS_PATH)
+    parser.add_argument('--transit', default=data_loader.TRANSIT_PATH)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes for the features (default: one per CPU)')
+    parser.add_argument('--clusters', type=int, default=N_CLUSTERS)
+    parser.add_argument('--algorithm', choices=['auto', 'kmeans', 'minibatch'], default='auto')
+    parser.add_argument('--seed', type=int, default=RANDOM_STATE)
+    parser.add_argument('--from-pickle', metavar='PATH',
+                        help='Convert a pickled {scaler, kmeans} model instead of training')
+    parser.add_argument('--check-parity', action='store_true',
+                        help='Compare the artifact with the pickled model (--from-pickle or kmeans_algo.pkl)')
+    args = parser.parse_args(argv)
+
+    if args.check_parity:
+        compared, mismatched = check_parity(args.output, args.from_pickle or data_loader.KMEANS_PATH, args.sites)
+        print(f'{mismatched} of {compared} rows classified differently')
+        raise SystemExit(1 if mismatched else 0)
+
+    start = time.perf_counter()
+    if args.from_pickle:
+        scaler, kmeans = data_loader.load_kmeans(args.from_pickle)
+        save_artifact(artifact(scaler, kmeans, source=args.from_pickle), args.output)
+        print(f'Converted {args.from_pickle} to {args.output}')
+        return
+    sites = gpd.read_file(args.sites).to_crs(data_loader.DISPLAY_CRS)
+    if not args.stored_features:
+        sites = site_features.build_site_features(sites, args.calls, args.roads, args.transit, args.workers)
+    scaler, kmeans = fit(sites, args.clusters, args.algorithm, args.seed)
+    arrays = artifact(scaler, kmeans, n_samples=len(sites), random_state=args.seed,
+                      source=args.sites)
+    save_artifact(arrays, args.output)
+
+    clusters = arrays['remap'][kmeans.labels_]
+    sizes = ', '.join(f'{cluster}: {count}' for cluster, count in zip(*np.unique(clusters, return_counts=True)))
+    print(f'Wrote {arrays["algorithm"]} model ({sizes}) to {args.output} in {time.perf_counter() - start:.2f}s')
+    if 'Cluster' in sites.columns:
+        print(f'Agreement with the sites file Cluster column: {np.mean(clusters == sites["Cluster"].to_numpy()):.1%}')
+
+
+if __name__ == '__main__':
+    main()